@@ -0,0 +1,122 @@
+"""Бенчмарк маршрутизации нажатий на кнопки.
+
+Сравнивает накладные расходы на выбор обработчика: прежняя цепочка
+if/elif по строкам callback_data против CallbackRouter (разбор кода и
+поиск в словаре). Сами обработчики не вызываются.
+
+    python benchmarks/callback_routing.py --iterations 1000000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from callbacks import CallbackRouter  # noqa: E402
+
+# Пары (старый callback_data, новый callback_data) для одних и тех же кнопок
+SAMPLES = [
+    ("main_menu", "menu"),
+    ("create_broadcast", "cb"),
+    ("list_broadcasts", "bcp"),
+    ("bcp|active|next|2024-01-01T12:00:00|42", "bcp|active|next|2024-01-01T12:00:00|42"),
+    ("view_broadcast_42", "vb|42"),
+    ("delete_broadcast_42", "db|42"),
+    ("manage_chats", "chats"),
+    ("add_chat", "ac"),
+    ("edit_chat_-1001234567890", "ec|-1001234567890"),
+    ("toggle_-1001234567890", "tc|-1001234567890"),
+    ("remove_-1001234567890", "rc|-1001234567890"),
+    ("manage_admins", "admins"),
+    ("add_admin", "aa"),
+    ("remove_admin_123456789", "ra|123456789"),
+    ("statistics", "stats"),
+    ("user_stats", "ustats"),
+    ("help", "help"),
+]
+
+
+def legacy_route(data: str):
+    """Копия ветвления прежнего button_handler: возвращает (имя, аргумент)"""
+    if data == "main_menu":
+        return "show_main_menu", None
+    elif data == "create_broadcast":
+        return "create_broadcast_start", None
+    elif data == "list_broadcasts" or data.startswith("bcp|"):
+        return "list_broadcasts", data
+    elif data.startswith("view_broadcast_"):
+        return "view_broadcast", data.replace("view_broadcast_", "")
+    elif data.startswith("delete_broadcast_"):
+        return "delete_broadcast", data.replace("delete_broadcast_", "")
+    elif data == "manage_chats":
+        return "manage_chats", None
+    elif data == "add_chat":
+        return "add_chat_start", None
+    elif data.startswith("edit_chat_"):
+        return "edit_chat", data.replace("edit_chat_", "")
+    elif data.startswith("toggle_"):
+        return "toggle_chat", data.replace("toggle_", "")
+    elif data.startswith("remove_admin_"):
+        return "remove_admin", data.replace("remove_admin_", "")
+    elif data.startswith("remove_"):
+        return "remove_chat", data.replace("remove_", "")
+    elif data == "manage_admins":
+        return "manage_admins", None
+    elif data == "add_admin":
+        return "add_admin_start", None
+    elif data == "statistics":
+        return "show_statistics", None
+    elif data == "user_stats":
+        return "view_user_stats", None
+    elif data == "help":
+        return "show_help", None
+    return None, None
+
+
+async def noop(update, context, *args):
+    pass
+
+
+def build_router() -> CallbackRouter:
+    router = CallbackRouter()
+    codes = {data.split(CallbackRouter.SEPARATOR, 1)[0] for _, data in SAMPLES}
+    for code in codes:
+        router.add(code, noop)
+    return router
+
+
+def bench(name: str, route, samples, iterations: int):
+    rounds = max(1, iterations // len(samples))
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for data in samples:
+            route(data)
+    elapsed = time.perf_counter() - started
+    calls = rounds * len(samples)
+    print(f"{name:<10} {elapsed / calls * 1e9:8.0f} ns/callback ({calls} calls)")
+    # Худший и лучший случай для цепочки - позиция ветки
+    for data in (samples[0], samples[-1]):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            route(data)
+        per_call = (time.perf_counter() - started) / rounds * 1e9
+        print(f"{'':<10} {per_call:8.0f} ns  {data}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    router = build_router()
+    bench("if/elif", legacy_route, [old for old, _ in SAMPLES], args.iterations)
+    bench("router", router.resolve, [new for _, new in SAMPLES], args.iterations)
+
+    old_size = sum(len(old.encode()) for old, _ in SAMPLES)
+    new_size = sum(len(new.encode()) for _, new in SAMPLES)
+    print(f"callback_data: {old_size} -> {new_size} bytes for {len(SAMPLES)} buttons")
+
+
+if __name__ == "__main__":
+    main()
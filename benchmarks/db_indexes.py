@@ -0,0 +1,148 @@
+"""Бенчмарк запросов к БД до и после индексов.
+
+Создает временную базу, заполняет ее синтетическими пользователями и
+печатает EXPLAIN QUERY PLAN и время каждого метода Database без индексов
+из database.INDEXES и с ними. План строится по SQL, который метод
+действительно выполнил (трассировка соединения).
+
+    python benchmarks/db_indexes.py --users 1000000 --chats 50
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from database import Database, INDEXES  # noqa: E402
+
+
+def seed(db: Database, users: int, chats: int, broadcasts: int):
+    rng = random.Random(42)
+    chat_ids = [str(-1001000000000 - i) for i in range(chats)]
+    with db.connection() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (user_id, chat_id, username, first_name, gender, age) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    rng.randrange(1, users * 2),
+                    rng.choice(chat_ids),
+                    None,
+                    None,
+                    rng.choice(("male", "female", None)),
+                    rng.choice((None, rng.randint(14, 80)))
+                )
+                for _ in range(users)
+            )
+        )
+        conn.executemany(
+            "INSERT INTO statistics (broadcast_id, chat_id, sent_at) VALUES (?, ?, datetime('now'))",
+            ((rng.randint(1, broadcasts), rng.choice(chat_ids)) for _ in range(broadcasts * chats))
+        )
+        # Журнал доставки прошлых рассылок: по нему считается статистика рассылки
+        conn.executemany(
+            "INSERT INTO deliveries (broadcast_id, user_id, status, sent_at) "
+            "VALUES (?, ?, ?, datetime('now'))",
+            (
+                (rng.randint(1, broadcasts), rng.randrange(1, users * 2),
+                 rng.choice(("sent", "sent", "sent", "failed")))
+                for _ in range(users)
+            )
+        )
+    return chat_ids
+
+
+def queries(db: Database, chat_ids, repeat: int):
+    """(имя, вызов метода Database); SQL для плана берется из самого вызова"""
+    chat = chat_ids[len(chat_ids) // 2]
+    # Путь отправки: каждый вызов enqueue_run ставит чат в очередь нового прогона,
+    # claim_outbox выдает пачки из очереди одного прогона
+    broadcast_id = db.create_broadcast("benchmark", "text", [chat], datetime.now())
+    runs = iter([db.create_run(broadcast_id, 1) for _ in range(repeat + 1)])
+    claim_run = db.create_run(broadcast_id, 1)
+    db.enqueue_run(claim_run, [chat])
+    return [
+        ("get_users_in_chat", lambda: db.get_users_in_chat(chat)),
+        ("get_users_in_chat(filters)",
+         lambda: db.get_users_in_chat(chat, gender="female", age_min=18, age_max=35)),
+        ("get_user_count", lambda: db.get_user_count(chat)),
+        ("get_user_stats", lambda: db.get_user_stats(chat)),
+        ("get_broadcast_stats", lambda: db.get_broadcast_stats(7)),
+        ("enqueue_run", lambda: db.enqueue_run(next(runs), [chat])),
+        ("claim_outbox", lambda: db.claim_outbox(claim_run, "benchmark", 100, 300)),
+    ]
+
+
+def traced(db: Database, call) -> List[str]:
+    """SQL, который выполнил вызов (с подставленными параметрами)"""
+    statements = []
+    # В пуле одно соединение (pool_size=1), трассировка ставится на него
+    with db.connection() as conn:
+        conn.set_trace_callback(statements.append)
+    try:
+        call()
+    finally:
+        with db.connection() as conn:
+            conn.set_trace_callback(None)
+    return [sql for sql in statements
+            if sql.lstrip().split(None, 1)[0].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")]
+
+
+def measure(db: Database, chat_ids, repeat: int):
+    results = {}
+    conn = db.get_connection()
+    for name, call in queries(db, chat_ids, repeat):
+        plan = [
+            row[3]
+            for sql in traced(db, call)
+            for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")
+        ]
+        started = time.perf_counter()
+        for _ in range(repeat):
+            call()
+        elapsed = (time.perf_counter() - started) / repeat
+        results[name] = (elapsed, plan)
+    conn.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--broadcasts", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    db = Database(path, pool_size=1)
+    print(f"Seeding {args.users} users into {path}...")
+    started = time.perf_counter()
+    chat_ids = seed(db, args.users, args.chats, args.broadcasts)
+    print(f"Seeded in {time.perf_counter() - started:.1f}s\n")
+
+    with db.connection() as conn:
+        for name, _, _ in INDEXES:
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+    before = measure(db, chat_ids, args.repeat)
+
+    with db.connection() as conn:
+        Database.create_indexes(conn)
+    after = measure(db, chat_ids, args.repeat)
+
+    for name, (elapsed, plan) in before.items():
+        new_elapsed, new_plan = after[name]
+        print(f"{name}: {elapsed * 1000:.1f}ms -> {new_elapsed * 1000:.1f}ms")
+        print(f"  before: {'; '.join(plan)}")
+        print(f"  after:  {'; '.join(new_plan)}")
+
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
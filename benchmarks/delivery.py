@@ -0,0 +1,366 @@
+"""Нагрузочный бенчмарк доставки рассылок на локальной заглушке Bot API.
+
+Заглушка (aiohttp, отдельный процесс) отвечает на sendMessage/copyMessage с
+заданной задержкой и может возвращать 429 (flood control), 403 (бот
+заблокирован) и 502. Бот подключается к ней через base_url, база - временная
+с синтетическими пользователями. Для каждой стратегии печатаются msg/s,
+p50/p99 задержки отправки, прирост памяти и задержка цикла событий.
+
+Стратегии:
+    send_message - BroadcastSender + bot.send_message (без outbox и журнала)
+    template     - BroadcastSender + MessageTemplate (без outbox и журнала)
+    scheduler    - BroadcastScheduler.send_broadcast: outbox, журнал доставки (как в боте)
+    processes    - send_broadcast при SENDER_PROCESSES > 0 и процессах worker.py
+
+    python benchmarks/delivery.py --users 20000 --latency 50 --flood-rate 0.001
+    python benchmarks/delivery.py --strategies scheduler,processes --processes 4
+
+Лимит SEND_RATE_LIMIT на время бенчмарка заменяется на --rate: с настоящими
+30 msg/s измерялся бы только токен-бакет. Память и задержка цикла событий
+считаются для основного процесса (у processes отправляют дочерние процессы).
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from aiohttp import web  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+
+from database import Database  # noqa: E402
+from scheduler import BroadcastScheduler  # noqa: E402
+from sender import BroadcastSender, MessageTemplate  # noqa: E402
+import config  # noqa: E402
+import worker  # noqa: E402
+
+TOKEN = "123456:BENCHMARK"
+CHAT_ID = "-1001000000000"
+TEXT = (
+    "<b>Большая распродажа!</b>\n\n"
+    "Скидки до 50% на все товары только до воскресенья. "
+    "Подробности: <a href=\"https://example.com/sale\">example.com/sale</a>"
+)
+
+
+# === ЗАГЛУШКА BOT API ===
+class FakeBotAPI:
+    """Ответы Bot API с задержкой и случайными ошибками"""
+
+    def __init__(self, latency: float, jitter: float, flood_rate: float, retry_after: int,
+                 error_rate: float, server_error_rate: float, seed: int = 42):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.server_error_rate = server_error_rate
+        self.rng = random.Random(seed)
+        self.message_id = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await request.post()
+        delay = self.latency + self.rng.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if method == "getMe":
+            return self._ok({"id": 123456, "is_bot": True, "first_name": "Benchmark",
+                             "username": "benchmark_bot"})
+        if method not in ("sendMessage", "copyMessage"):
+            return self._ok(True)
+
+        roll = self.rng.random()
+        if roll < self.flood_rate:
+            return self._error(429, f"Too Many Requests: retry after {self.retry_after}",
+                               {"retry_after": self.retry_after})
+        roll -= self.flood_rate
+        if roll < self.error_rate:
+            return self._error(403, "Forbidden: bot was blocked by the user")
+        roll -= self.error_rate
+        if roll < self.server_error_rate:
+            return self._error(502, "Bad Gateway")
+
+        self.message_id += 1
+        if method == "copyMessage":
+            return self._ok({"message_id": self.message_id})
+        chat_id = int(params.get("chat_id", 0))
+        return self._ok({
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": "User"},
+            "from": {"id": 123456, "is_bot": True, "first_name": "Benchmark"},
+            "text": params.get("text", ""),
+        })
+
+    @staticmethod
+    def _ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    @staticmethod
+    def _error(code: int, description: str, parameters: dict = None) -> web.Response:
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+
+def run_fake_api(port: int, options: Dict):
+    api = FakeBotAPI(**options)
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    web.run_app(app, host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Fake Bot API did not start on port {port}")
+
+
+# === ИЗМЕРЕНИЯ ===
+def rss_mb() -> float:
+    """Текущий RSS процесса (Linux); на других ОС - пиковый"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+class LoopMonitor:
+    """Задержка цикла событий (насколько позже срабатывает sleep) и пик памяти"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags: List[float] = []
+        self.rss_start = 0.0
+        self.rss_peak = 0.0
+        self._task = None
+
+    def start(self):
+        self.rss_start = self.rss_peak = rss_mb()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - started - self.interval))
+            if len(self.lags) % 10 == 0:
+                self.rss_peak = max(self.rss_peak, rss_mb())
+
+    async def stop(self):
+        self._task.cancel()
+        self.rss_peak = max(self.rss_peak, rss_mb())
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))]
+
+
+# === СТРАТЕГИИ ===
+def make_sender() -> BroadcastSender:
+    return BroadcastSender(
+        workers=config.SEND_WORKERS,
+        rate=config.SEND_RATE_LIMIT,
+        per_chat_interval=config.SEND_PER_CHAT_INTERVAL,
+        max_retries=config.SEND_MAX_RETRIES,
+        backoff_base=config.SEND_BACKOFF_BASE,
+        backoff_max=config.SEND_BACKOFF_MAX
+    )
+
+
+async def direct(bot, db: Database, use_template: bool) -> Dict:
+    """Отправка по списку получателей в памяти, без записи в БД"""
+    recipients = [user["user_id"] for user in db.get_users_in_chat(CHAT_ID)]
+    if use_template:
+        send = MessageTemplate.text(bot, TEXT).send
+    else:
+        async def send(chat_id):
+            return await bot.send_message(chat_id=chat_id, text=TEXT, parse_mode="HTML")
+    report = await make_sender().deliver(recipients, send)
+    return {
+        "sent": report.sent,
+        "failed": report.failed,
+        "duration": report.duration,
+        "latencies": report.latencies,
+    }
+
+
+async def scheduled(bot, db: Database, processes: int) -> Dict:
+    """Полный путь рассылки бота: прогон, outbox, журнал доставки"""
+    config.SENDER_PROCESSES = processes
+    broadcast_id = db.create_broadcast(
+        "benchmark", TEXT, [CHAT_ID], datetime.now(), frequency="once", repeat_count=1
+    )
+    senders = [multiprocessing.Process(target=run_sender_process,
+                                       args=(index, snapshot_config(), logging.getLogger().level))
+               for index in range(processes)]
+    for process in senders:
+        process.start()
+    scheduler = BroadcastScheduler(bot, db)
+    # Как в боте: доля лимита под приветствия при SENDER_PROCESSES > 0
+    scheduler.start_rate_sharing()
+    try:
+        started = datetime.now()
+        await scheduler.send_broadcast(broadcast_id)
+    finally:
+        await scheduler.stop_rate_sharing()
+        for process in senders:
+            process.terminate()
+        for process in senders:
+            process.join()
+        config.SENDER_PROCESSES = 0
+
+    with db.connection() as conn:
+        run_id = conn.execute(
+            "SELECT id FROM broadcast_runs WHERE broadcast_id = ?", (broadcast_id,)
+        ).fetchone()[0]
+        rows = conn.execute(
+            "SELECT status, latency_ms, sent_at FROM deliveries WHERE run_id = ?", (run_id,)
+        ).fetchall()
+    # Длительность - до последней записи журнала, без интервала опроса очереди ботом
+    finished = max((datetime.fromisoformat(row[2]) for row in rows), default=started)
+    return {
+        "sent": sum(1 for row in rows if row[0] == "sent"),
+        "failed": sum(1 for row in rows if row[0] == "failed"),
+        "duration": (finished - started).total_seconds(),
+        "latencies": [row[1] / 1000 for row in rows],
+    }
+
+
+# Настройки, которые бенчмарк меняет и передает процессам-отправителям
+OVERRIDES = ("BOT_TOKEN", "BOT_API_URL", "DATABASE_PATH", "SEND_RATE_LIMIT", "SEND_WORKERS",
+             "SENDER_HEARTBEAT_INTERVAL", "SENDER_PROCESSES")
+
+
+def snapshot_config() -> Dict:
+    return {name: getattr(config, name) for name in OVERRIDES}
+
+
+def run_sender_process(index: int, settings: Dict, log_level: int):
+    for name, value in settings.items():
+        setattr(config, name, value)
+    logging.getLogger().setLevel(log_level)
+    worker.run_process(index)
+
+
+async def run_strategy(name: str, bot, db: Database, args) -> Dict:
+    if name == "send_message":
+        return await direct(bot, db, use_template=False)
+    if name == "template":
+        return await direct(bot, db, use_template=True)
+    if name == "scheduler":
+        return await scheduled(bot, db, processes=0)
+    if name == "processes":
+        return await scheduled(bot, db, processes=args.processes)
+    raise ValueError(f"Unknown strategy: {name}")
+
+
+async def bench(args, db: Database, port: int):
+    config.BOT_API_URL = f"http://127.0.0.1:{port}/bot"
+    application = Application.builder().token(TOKEN).base_url(config.BOT_API_URL).build()
+    async with application:
+        bot = application.bot
+        print(f"{'strategy':<13} {'msg/s':>8} {'p50 ms':>7} {'p99 ms':>7} {'sent':>7} "
+              f"{'failed':>6} {'mem MB':>7} {'lag p99':>8} {'lag max':>8}")
+        for name in args.strategies.split(","):
+            monitor = LoopMonitor()
+            monitor.start()
+            result = await run_strategy(name.strip(), bot, db, args)
+            await monitor.stop()
+            total = result["sent"] + result["failed"]
+            throughput = total / result["duration"] if result["duration"] > 0 else 0.0
+            print(f"{name:<13} {throughput:8.1f} "
+                  f"{percentile(result['latencies'], 50) * 1000:7.1f} "
+                  f"{percentile(result['latencies'], 99) * 1000:7.1f} "
+                  f"{result['sent']:7d} {result['failed']:6d} "
+                  f"{monitor.rss_peak - monitor.rss_start:+7.1f} "
+                  f"{percentile(monitor.lags, 99) * 1000:6.1f}ms "
+                  f"{max(monitor.lags, default=0) * 1000:6.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--strategies", default="send_message,template,scheduler,processes")
+    parser.add_argument("--processes", type=int, default=2, help="процессов для стратегии processes")
+    parser.add_argument("--rate", type=float, default=1000, help="SEND_RATE_LIMIT на время бенчмарка")
+    parser.add_argument("--workers", type=int, default=config.SEND_WORKERS)
+    parser.add_argument("--latency", type=float, default=30, help="задержка ответа заглушки, мс")
+    parser.add_argument("--jitter", type=float, default=10, help="разброс задержки, +- мс")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, с")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 403")
+    parser.add_argument("--server-error-rate", type=float, default=0.0, help="доля ответов 502")
+    parser.add_argument("--db", help="файл базы (по умолчанию - временный)")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+    config.BOT_TOKEN = TOKEN
+    config.SEND_RATE_LIMIT = args.rate
+    config.SEND_WORKERS = args.workers
+    # Процессы-отправители и бот быстрее замечают новый прогон и конец очереди
+    config.SENDER_HEARTBEAT_INTERVAL = 0.2
+
+    port = free_port()
+    api = multiprocessing.Process(target=run_fake_api, args=(port, {
+        "latency": args.latency / 1000,
+        "jitter": args.jitter / 1000,
+        "flood_rate": args.flood_rate,
+        "retry_after": args.retry_after,
+        "error_rate": args.error_rate,
+        "server_error_rate": args.server_error_rate,
+    }), daemon=True)
+    api.start()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config.DATABASE_PATH = args.db or os.path.join(tmp, "bench.db")
+        db = Database(config.DATABASE_PATH, pool_size=config.DB_POOL_SIZE)
+        db.init_db()
+        started = time.perf_counter()
+        db.add_users_bulk((user_id, CHAT_ID, None, f"User {user_id}", None, None)
+                          for user_id in range(1, args.users + 1))
+        print(f"Seeded {args.users} users in {time.perf_counter() - started:.1f}s; "
+              f"fake API latency {args.latency:.0f}+-{args.jitter:.0f}ms, 429 {args.flood_rate:.2%}, "
+              f"403 {args.error_rate:.2%}, 502 {args.server_error_rate:.2%}")
+        try:
+            wait_for_port(port)
+            asyncio.run(bench(args, db, port))
+        finally:
+            db.close()
+            api.terminate()
+            api.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Бенчмарк CPU на одну отправку: bot.send_message против MessageTemplate.
+
+Сеть подменена запросом, который сразу возвращает готовый ответ Bot API,
+поэтому измеряется только работа бота: сборка и кодирование параметров
+и разбор ответа.
+
+    python benchmarks/send_payload.py --sends 100000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from telegram import Bot  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+from sender import MessageTemplate  # noqa: E402
+
+TEXT = (
+    "<b>Большая распродажа!</b>\n\n"
+    "Скидки до 50% на все товары только до воскресенья. "
+    "Подробности: <a href=\"https://example.com/sale\">example.com/sale</a>\n\n"
+    "<i>Вы получили это сообщение, потому что состоите в нашем чате.</i>"
+)
+
+
+class FakeRequest(BaseRequest):
+    """Запрос без сети: сохраняет последние параметры и отвечает как sendMessage"""
+
+    def __init__(self):
+        self.last_parameters = None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        params = request_data.json_parameters
+        self.last_parameters = params
+        chat_id = int(params["chat_id"])
+        return 200, json.dumps({"ok": True, "result": {
+            "message_id": 1,
+            "date": 1700000000,
+            "chat": {"id": chat_id, "type": "private", "first_name": "User"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Bot"},
+            "text": "text",
+        }}).encode()
+
+
+async def bench(name: str, send, sends: int):
+    started = time.process_time()
+    for chat_id in range(1, sends + 1):
+        await send(chat_id)
+    elapsed = time.process_time() - started
+    print(f"{name:<14} {elapsed / sends * 1e6:7.1f} us CPU/send ({sends} sends)")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sends", type=int, default=100_000)
+    args = parser.parse_args()
+
+    request = FakeRequest()
+    bot = Bot("123456:TEST", request=request)
+
+    async def send_message(chat_id):
+        return await bot.send_message(chat_id=chat_id, text=TEXT, parse_mode="HTML")
+
+    await send_message(42)
+    expected = request.last_parameters
+    template = MessageTemplate.text(bot, TEXT, parse_mode="HTML")
+    await template.send(42)
+    assert request.last_parameters == expected, (request.last_parameters, expected)
+
+    await bench("send_message", send_message, args.sends)
+    await bench("template", template.send, args.sends)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,3 +1,4 @@
+import io
 import logging
 from datetime import datetime, timedelta
 import pytz
@@ -14,7 +15,12 @@ from telegram.ext import (
 
 from database import Database
 from scheduler import BroadcastScheduler
+from link_tracker import LinkTracker
+from callbacks import CallbackRouter
+from user_import import UserImport
+from member_joins import UserBatcher, WelcomeQueue
 import config
+import metrics
 
 # Настройка логирования
 logging.basicConfig(
@@ -29,32 +35,52 @@ logger = logging.getLogger(__name__)
  BROADCAST_GENDER, BROADCAST_AGE_MIN, BROADCAST_AGE_MAX,
  ADD_CHAT_ID, ADD_CHAT_NAME,
  REGISTER_GENDER, REGISTER_AGE,
- ADD_ADMIN_ID) = range(14)
+ ADD_ADMIN_ID,
+ IMPORT_FILE) = range(15)
 
 # Глобальные объекты
-db = Database(config.DATABASE_PATH)
+db = Database(
+    config.DATABASE_PATH,
+    pool_size=config.DB_POOL_SIZE,
+    admin_cache_ttl=config.ADMIN_CACHE_TTL,
+    busy_timeout=config.DB_BUSY_TIMEOUT
+)
 scheduler = None
+# Вступления в чаты: запись пачками и очередь приветствий (создаются в main)
+user_batcher = None
+welcome_queue = None
+# Замер задержки цикла событий для метрик (создается в post_init)
+loop_monitor = None
+# Трекинг кликов по ссылкам (включается LINK_TRACKING_BASE_URL)
+link_tracker = None
+# Кнопки: код действия -> обработчик (регистрация в разделе CALLBACK HANDLERS)
+router = CallbackRouter()
 
 # Московское время (UTC+3)
 MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 
+# Типы обновлений, которые обрабатывают хендлеры (команды, сообщения,
+# новые участники чата и кнопки); остальные Telegram не присылает
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
 
 def admin_only(func):
     """Декоратор для проверки прав администратора"""
-    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
         user_id = update.effective_user.id
+        # Проверка прав идет по кэшу в памяти, без запроса к БД
         if not db.is_admin(user_id):
-            await update.message.reply_text(
+            await update.effective_message.reply_text(
                 "❌ У вас нет прав для выполнения этой команды."
             )
             return ConversationHandler.END
-        return await func(update, context)
+        return await func(update, context, *args)
     return wrapper
 
 
 def owner_only(func):
     """Декоратор для проверки прав главного администратора"""
-    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
         user_id = update.effective_user.id
         if not db.is_owner(user_id):
             if update.callback_query:
@@ -67,7 +93,7 @@ def owner_only(func):
                     "❌ Только главный администратор может выполнять это действие!"
                 )
             return ConversationHandler.END
-        return await func(update, context)
+        return await func(update, context, *args)
     return wrapper
 
 
@@ -78,7 +104,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Добавляем первого админа как owner (главный администратор)
     if user_id == config.FIRST_ADMIN_ID and not db.is_admin(user_id):
-        db.add_admin(user_id, username, role='owner')
+        await db.aio.add_admin(user_id, username, role='owner')
         logger.info(f"Added first admin (owner): {user_id}")
 
     if not db.is_admin(user_id):
@@ -96,19 +122,19 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     is_owner = db.is_owner(user_id)
 
     keyboard = [
-        [InlineKeyboardButton("📤 Создать рассылку", callback_data="create_broadcast")],
-        [InlineKeyboardButton("📋 Мои рассылки", callback_data="list_broadcasts")],
-        [InlineKeyboardButton("👥 Управление чатами", callback_data="manage_chats")],
+        [InlineKeyboardButton("📤 Создать рассылку", callback_data=router.data("cb"))],
+        [InlineKeyboardButton("📋 Мои рассылки", callback_data=router.data("bcp"))],
+        [InlineKeyboardButton("👥 Управление чатами", callback_data=router.data("chats"))],
     ]
 
     # Кнопка "Администраторы" видна только главному администратору
     if is_owner:
-        keyboard.append([InlineKeyboardButton("👨‍💼 Администраторы", callback_data="manage_admins")])
+        keyboard.append([InlineKeyboardButton("👨‍💼 Администраторы", callback_data=router.data("admins"))])
 
     keyboard.extend([
-        [InlineKeyboardButton("📊 Статистика", callback_data="statistics")],
-        [InlineKeyboardButton("👤 Пользователи", callback_data="user_stats")],
-        [InlineKeyboardButton("ℹ️ Помощь", callback_data="help")]
+        [InlineKeyboardButton("📊 Статистика", callback_data=router.data("stats"))],
+        [InlineKeyboardButton("👤 Пользователи", callback_data=router.data("ustats"))],
+        [InlineKeyboardButton("ℹ️ Помощь", callback_data=router.data("help"))]
     ])
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -149,17 +175,26 @@ async def broadcast_title(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Шаг 2/6: Введите текст рассылки:\n\n"
         "Вы можете использовать HTML-форматирование:\n"
-        "<b>жирный</b>, <i>курсив</i>, <code>код</code>"
+        "<b>жирный</b>, <i>курсив</i>, <code>код</code>\n\n"
+        "Или отправьте (перешлите) сообщение с фото, видео или файлом - "
+        "оно будет скопировано получателям без повторной загрузки."
     )
     return BROADCAST_TEXT
 
 
 async def broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Получение текста рассылки"""
-    context.user_data['broadcast_text'] = update.message.text
+    """Получение текста рассылки или сообщения с медиа"""
+    message = update.message
+    if message.text is not None:
+        context.user_data['broadcast_text'] = message.text
+        context.user_data['broadcast_source'] = None
+    else:
+        # Медиа не сохраняем: при отправке сообщение копируется через copyMessage
+        context.user_data['broadcast_text'] = message.caption_html or ""
+        context.user_data['broadcast_source'] = (message.chat_id, message.message_id)
 
     # Показываем доступные чаты
-    chats = db.get_target_chats(active_only=True)
+    chats = await db.aio.get_target_chats(active_only=True)
     if not chats:
         await update.message.reply_text(
             "❌ У вас нет активных чатов для рассылки.\n"
@@ -206,7 +241,7 @@ async def toggle_chat_selection(update: Update, context: ContextTypes.DEFAULT_TY
     context.user_data['selected_chats'] = selected
 
     # Обновляем кнопки
-    chats = db.get_target_chats(active_only=True)
+    chats = await db.aio.get_target_chats(active_only=True)
     keyboard = []
     for chat in chats:
         mark = "✅" if chat['chat_id'] in selected else "❌"
@@ -490,7 +525,8 @@ async def broadcast_age_max(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def save_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Сохранение рассылки и запуск"""
     try:
-        broadcast_id = db.create_broadcast(
+        source_chat_id, source_message_id = context.user_data.get('broadcast_source') or (None, None)
+        broadcast_id = await db.aio.create_broadcast(
             title=context.user_data['broadcast_title'],
             message_text=context.user_data['broadcast_text'],
             target_chats=context.user_data['selected_chats'],
@@ -499,11 +535,20 @@ async def save_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
             repeat_count=context.user_data.get('repeat_count', 1),
             gender_filter=context.user_data.get('gender_filter'),
             age_min=context.user_data.get('age_min'),
-            age_max=context.user_data.get('age_max')
+            age_max=context.user_data.get('age_max'),
+            source_chat_id=source_chat_id,
+            source_message_id=source_message_id
         )
 
+        # Заменяем ссылки на короткие для подсчета кликов
+        if link_tracker:
+            message_text = context.user_data['broadcast_text']
+            tracked_text = await link_tracker.rewrite(broadcast_id, message_text)
+            if tracked_text != message_text:
+                await db.aio.update_broadcast_text(broadcast_id, tracked_text)
+
         # Планируем рассылку
-        scheduler.schedule_broadcast(broadcast_id)
+        scheduler.schedule_broadcast(broadcast_id, await db.aio.get_broadcast(broadcast_id))
 
         freq_text = {
             "once": "один раз",
@@ -564,14 +609,40 @@ async def save_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # === СПИСОК РАССЫЛОК ===
-async def list_broadcasts(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показать список рассылок"""
+# Рассылок на одной странице списка
+BROADCASTS_PAGE_SIZE = 10
+
+BROADCAST_STATUS_EMOJI = {
+    "pending": "⏳",
+    "active": "✅",
+    "completed": "✔️",
+    "failed": "❌"
+}
+
+
+def broadcasts_page_data(status: str = None, direction: str = "next", cursor: dict = None) -> str:
+    """callback_data страницы списка: bcp|статус|направление|created_at|id"""
+    if cursor:
+        return router.data("bcp", status or "", direction, cursor['created_at'], cursor['id'])
+    return router.data("bcp", status or "", direction, "", "")
+
+
+async def list_broadcasts(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                          status: str = "", direction: str = "next",
+                          created_at: str = "", bc_id: str = ""):
+    """Показать список рассылок (постранично, с фильтром по статусу)"""
     query = update.callback_query
     await query.answer()
 
-    broadcasts = db.get_broadcasts()
+    status = status or None
+    cursor = (created_at, int(bc_id)) if bc_id else None
 
-    if not broadcasts:
+    page = await db.aio.get_broadcasts_page(
+        status=status, cursor=cursor, direction=direction, limit=BROADCASTS_PAGE_SIZE
+    )
+    broadcasts = page['items']
+
+    if not broadcasts and not status and not cursor:
         await query.message.reply_text(
             "📋 У вас пока нет рассылок.\n"
             "Создайте первую через меню!"
@@ -580,19 +651,16 @@ async def list_broadcasts(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     text = "📋 <b>Ваши рассылки:</b>\n\n"
+    if not broadcasts:
+        text += "Нет рассылок с таким статусом.\n"
+
     keyboard = []
 
     for bc in broadcasts:
-        status_emoji = {
-            "pending": "⏳",
-            "active": "✅",
-            "completed": "✔️",
-            "failed": "❌"
-        }
-        emoji = status_emoji.get(bc['status'], "❓")
+        emoji = BROADCAST_STATUS_EMOJI.get(bc['status'], "❓")
 
         text += (
-            f"{emoji} <b>{bc['title']}</b>\n"
+            f"{emoji} <b>{bc['title'][:100]}</b>\n"
             f"   ID: {bc['id']} | {bc['status']}\n"
             f"   {bc['scheduled_time']}\n\n"
         )
@@ -600,29 +668,52 @@ async def list_broadcasts(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard.append([
             InlineKeyboardButton(
                 f"{emoji} {bc['title'][:20]}...",
-                callback_data=f"view_broadcast_{bc['id']}"
+                callback_data=router.data("vb", bc['id'])
             )
         ])
 
-    keyboard.append([InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")])
+    # Навигация по страницам
+    navigation = []
+    if page['has_prev'] and broadcasts:
+        navigation.append(InlineKeyboardButton(
+            "⬅️ Новее", callback_data=broadcasts_page_data(status, "prev", broadcasts[0])
+        ))
+    if page['has_next'] and broadcasts:
+        navigation.append(InlineKeyboardButton(
+            "Старее ➡️", callback_data=broadcasts_page_data(status, "next", broadcasts[-1])
+        ))
+    if navigation:
+        keyboard.append(navigation)
+
+    # Фильтры по статусу
+    filters_row = [InlineKeyboardButton(
+        "• Все •" if status is None else "Все", callback_data=broadcasts_page_data()
+    )]
+    for bc_status, emoji in BROADCAST_STATUS_EMOJI.items():
+        label = f"•{emoji}•" if status == bc_status else emoji
+        filters_row.append(InlineKeyboardButton(label, callback_data=broadcasts_page_data(bc_status)))
+    keyboard.append(filters_row)
+
+    keyboard.append([InlineKeyboardButton("🏠 Главное меню", callback_data=router.data("menu"))])
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.message.edit_text(text, reply_markup=reply_markup, parse_mode="HTML")
 
 
-async def view_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def view_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, broadcast_id: str):
     """Просмотр деталей рассылки"""
     query = update.callback_query
     await query.answer()
 
-    broadcast_id = int(query.data.replace("view_broadcast_", ""))
-    broadcast = db.get_broadcast(broadcast_id)
+    broadcast_id = int(broadcast_id)
+    broadcast = await db.aio.get_broadcast(broadcast_id)
 
     if not broadcast:
         await query.message.reply_text("❌ Рассылка не найдена")
         return
 
-    stats = db.get_broadcast_stats(broadcast_id)
+    stats = await db.aio.get_broadcast_stats(broadcast_id)
+    run = await db.aio.get_open_run(broadcast_id)
 
     text = (
         f"📊 <b>Рассылка: {broadcast['title']}</b>\n\n"
@@ -636,30 +727,63 @@ async def view_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"✅ Доставлено: {stats['delivered']}\n"
         f"👀 Просмотров: {stats['total_views']}\n"
         f"🖱 Кликов: {stats['total_clicks']}\n\n"
-        f"💬 <b>Текст:</b>\n{broadcast['message_text']}"
     )
+    if run:
+        # Текущий прогон по очереди outbox
+        progress = await db.aio.get_outbox_progress(run["id"])
+        text += (
+            f"{'⏸ Прогон на паузе' if run['status'] == 'paused' else '⏳ Идет отправка'}: "
+            f"в очереди {progress['queued']}, отправляется {progress['leased']}, "
+            f"отправлено {progress['sent']}, ошибок {progress['failed']}\n\n"
+        )
+    if broadcast.get("source_message_id"):
+        text += "📎 <b>Медиа</b> (копия исходного сообщения)\n"
+    text += f"💬 <b>Текст:</b>\n{broadcast['message_text']}"
 
-    keyboard = [
-        [InlineKeyboardButton("🗑 Удалить", callback_data=f"delete_broadcast_{broadcast_id}")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="list_broadcasts")]
+    keyboard = []
+    if run and run["status"] == "paused":
+        keyboard.append([InlineKeyboardButton(
+            "▶️ Продолжить", callback_data=router.data("rr", run["id"], broadcast_id)
+        )])
+    elif run:
+        keyboard.append([InlineKeyboardButton(
+            "⏸ Пауза", callback_data=router.data("rp", run["id"], broadcast_id)
+        )])
+    keyboard += [
+        [InlineKeyboardButton("🗑 Удалить", callback_data=router.data("db", broadcast_id))],
+        [InlineKeyboardButton("🔙 Назад", callback_data=router.data("bcp"))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.message.edit_text(text, reply_markup=reply_markup, parse_mode="HTML")
 
 
-async def delete_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def pause_run(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                    run_id: str, broadcast_id: str):
+    """Приостановить отправку текущего прогона"""
+    await db.aio.set_run_paused(int(run_id), True)
+    await view_broadcast(update, context, broadcast_id)
+
+
+async def resume_run(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                     run_id: str, broadcast_id: str):
+    """Продолжить отправку приостановленного прогона"""
+    await db.aio.set_run_paused(int(run_id), False)
+    await view_broadcast(update, context, broadcast_id)
+
+
+async def delete_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, broadcast_id: str):
     """Удаление рассылки"""
     query = update.callback_query
     await query.answer()
 
-    broadcast_id = int(query.data.replace("delete_broadcast_", ""))
+    broadcast_id = int(broadcast_id)
 
     # Отменяем запланированную задачу
     scheduler.cancel_broadcast(broadcast_id)
 
     # Удаляем из БД
-    db.delete_broadcast(broadcast_id)
+    await db.aio.delete_broadcast(broadcast_id)
 
     await query.message.reply_text("✅ Рассылка удалена")
     await list_broadcasts(update, context)
@@ -671,7 +795,7 @@ async def manage_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    chats = db.get_target_chats(active_only=False)
+    chats = await db.aio.get_target_chats(active_only=False)
 
     keyboard = []
     text = "👥 <b>Управление чатами</b>\n\n"
@@ -684,14 +808,14 @@ async def manage_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
             keyboard.append([
                 InlineKeyboardButton(
                     f"{status} {chat['chat_name'][:25]}",
-                    callback_data=f"edit_chat_{chat['chat_id']}"
+                    callback_data=router.data("ec", chat['chat_id'])
                 )
             ])
     else:
         text += "У вас пока нет добавленных чатов.\n"
 
-    keyboard.append([InlineKeyboardButton("➕ Добавить чат", callback_data="add_chat")])
-    keyboard.append([InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")])
+    keyboard.append([InlineKeyboardButton("➕ Добавить чат", callback_data=router.data("ac"))])
+    keyboard.append([InlineKeyboardButton("🏠 Главное меню", callback_data=router.data("menu"))])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.message.edit_text(text, reply_markup=reply_markup, parse_mode="HTML")
@@ -759,7 +883,7 @@ async def add_chat_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return ConversationHandler.END
 
         # Добавляем в БД
-        db.add_target_chat(chat_id, chat_name, chat.type)
+        await db.aio.add_target_chat(chat_id, chat_name, chat.type)
 
         # Отправляем приветственное сообщение в чат с просьбой зарегистрироваться
         keyboard = [[InlineKeyboardButton("📝 Зарегистрироваться", url=f"https://t.me/{context.bot.username}?start=register")]]
@@ -800,17 +924,15 @@ async def add_chat_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
-async def edit_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def edit_chat(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: str):
     """Редактирование чата"""
     query = update.callback_query
     await query.answer()
 
-    chat_id = query.data.replace("edit_chat_", "")
-
     keyboard = [
-        [InlineKeyboardButton("🔄 Вкл/Выкл", callback_data=f"toggle_{chat_id}")],
-        [InlineKeyboardButton("🗑 Удалить", callback_data=f"remove_{chat_id}")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="manage_chats")]
+        [InlineKeyboardButton("🔄 Вкл/Выкл", callback_data=router.data("tc", chat_id))],
+        [InlineKeyboardButton("🗑 Удалить", callback_data=router.data("rc", chat_id))],
+        [InlineKeyboardButton("🔙 Назад", callback_data=router.data("chats"))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -820,25 +942,23 @@ async def edit_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-async def toggle_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def toggle_chat(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: str):
     """Включение/выключение чата"""
     query = update.callback_query
     await query.answer()
 
-    chat_id = query.data.replace("toggle_", "")
-    db.toggle_target_chat(chat_id)
+    await db.aio.toggle_target_chat(chat_id)
 
     await query.answer("✅ Статус изменен")
     await manage_chats(update, context)
 
 
-async def remove_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def remove_chat(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: str):
     """Удаление чата"""
     query = update.callback_query
     await query.answer()
 
-    chat_id = query.data.replace("remove_", "")
-    db.remove_target_chat(chat_id)
+    await db.aio.remove_target_chat(chat_id)
 
     await query.answer("✅ Чат удален")
     await manage_chats(update, context)
@@ -851,7 +971,7 @@ async def manage_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    admins = db.get_admins()
+    admins = await db.aio.get_admins()
 
     keyboard = []
     text = "👨‍💼 <b>Управление администраторами</b>\n\n"
@@ -873,15 +993,15 @@ async def manage_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 keyboard.append([
                     InlineKeyboardButton(
                         f"🗑 Удалить {username_display}",
-                        callback_data=f"remove_admin_{admin['user_id']}"
+                        callback_data=router.data("ra", admin['user_id'])
                     )
                 ])
             text += "\n"
     else:
         text += "Нет администраторов.\n"
 
-    keyboard.append([InlineKeyboardButton("➕ Добавить администратора", callback_data="add_admin")])
-    keyboard.append([InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")])
+    keyboard.append([InlineKeyboardButton("➕ Добавить администратора", callback_data=router.data("aa"))])
+    keyboard.append([InlineKeyboardButton("🏠 Главное меню", callback_data=router.data("menu"))])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
     await query.message.edit_text(text, reply_markup=reply_markup, parse_mode="HTML")
@@ -920,7 +1040,7 @@ async def add_admin_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return ConversationHandler.END
 
         # Добавляем администратора
-        if db.add_admin(admin_id):
+        if await db.aio.add_admin(admin_id):
             await update.message.reply_text(
                 f"✅ Администратор успешно добавлен!\n"
                 f"ID: <code>{admin_id}</code>\n\n"
@@ -945,12 +1065,12 @@ async def add_admin_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 @owner_only
-async def remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, admin_id: str):
     """Удаление администратора (только для главного администратора)"""
     query = update.callback_query
     await query.answer()
 
-    admin_id = int(query.data.replace("remove_admin_", ""))
+    admin_id = int(admin_id)
 
     # Защита от удаления owner
     if admin_id == config.FIRST_ADMIN_ID:
@@ -958,7 +1078,7 @@ async def remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Удаляем администратора
-    if db.remove_admin(admin_id):
+    if await db.aio.remove_admin(admin_id):
         await query.answer("✅ Администратор удален")
         logger.info(f"Admin removed: {admin_id} by {update.effective_user.id}")
     else:
@@ -974,26 +1094,17 @@ async def show_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    broadcasts = db.get_broadcasts()
-    total_sent = 0
-    total_delivered = 0
-    total_clicks = 0
-
-    for bc in broadcasts:
-        stats = db.get_broadcast_stats(bc['id'])
-        total_sent += stats['total_sent']
-        total_delivered += stats['delivered']
-        total_clicks += stats['total_clicks']
+    stats = await db.aio.get_statistics_summary()
 
     text = (
         "📊 <b>Общая статистика</b>\n\n"
-        f"📋 Всего рассылок: {len(broadcasts)}\n"
-        f"📤 Отправлено сообщений: {total_sent}\n"
-        f"✅ Доставлено: {total_delivered}\n"
-        f"🖱 Всего кликов: {total_clicks}\n"
+        f"📋 Всего рассылок: {stats['total_broadcasts']}\n"
+        f"📤 Отправлено сообщений: {stats['total_sent']}\n"
+        f"✅ Доставлено: {stats['delivered']}\n"
+        f"🖱 Всего кликов: {stats['total_clicks']}\n"
     )
 
-    keyboard = [[InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]]
+    keyboard = [[InlineKeyboardButton("🏠 Главное меню", callback_data=router.data("menu"))]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.message.edit_text(text, reply_markup=reply_markup, parse_mode="HTML")
@@ -1024,10 +1135,11 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "4. Добавьте ID через меню 'Управление чатами'\n\n"
         "<b>Команды:</b>\n"
         "/start - Главное меню\n"
-        "/help - Показать эту помощь"
+        "/help - Показать эту помощь\n"
+        "/import [chat_id] - Загрузить участников из CSV/JSON/JSONL"
     )
 
-    keyboard = [[InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]]
+    keyboard = [[InlineKeyboardButton("🏠 Главное меню", callback_data=router.data("menu"))]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     if query:
@@ -1043,7 +1155,7 @@ async def register_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = str(update.effective_chat.id)
 
     # Проверяем, зарегистрирован ли уже
-    user = db.get_user(user_id, chat_id)
+    user = await db.aio.get_user(user_id, chat_id)
 
     if user and user.get('gender') and user.get('age'):
         await update.message.reply_text(
@@ -1055,7 +1167,7 @@ async def register_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     # Сохраняем базовую информацию
-    db.add_or_update_user(
+    await db.aio.add_or_update_user(
         user_id=user_id,
         chat_id=chat_id,
         username=update.effective_user.username,
@@ -1106,7 +1218,7 @@ async def register_age(update: Update, context: ContextTypes.DEFAULT_TYPE):
         gender = context.user_data.get('register_gender')
 
         # Сохраняем данные
-        db.add_or_update_user(
+        await db.aio.add_or_update_user(
             user_id=user_id,
             chat_id=chat_id,
             username=update.effective_user.username,
@@ -1138,7 +1250,9 @@ async def view_user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if query:
         await query.answer()
 
-    stats = db.get_user_stats()
+    # Общая статистика и разбивка по чатам - одним запросом
+    user_stats = await db.aio.get_user_stats_by_chat()
+    stats = user_stats['total']
 
     text = (
         "📊 <b>Статистика пользователей</b>\n\n"
@@ -1152,14 +1266,14 @@ async def view_user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text += f"📈 Средний возраст: {stats['avg_age']} лет\n"
 
     # Статистика по чатам
-    chats = db.get_target_chats()
+    chats = await db.aio.get_target_chats()
     if chats:
         text += "\n<b>По чатам:</b>\n"
         for chat in chats:
-            chat_stats = db.get_user_stats(chat['chat_id'])
-            text += f"\n📍 {chat['chat_name']}: {chat_stats['total']} чел."
+            chat_total = user_stats['chats'].get(chat['chat_id'], {}).get('total', 0)
+            text += f"\n📍 {chat['chat_name']}: {chat_total} чел."
 
-    keyboard = [[InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]]
+    keyboard = [[InlineKeyboardButton("🏠 Главное меню", callback_data=router.data("menu"))]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     if query:
@@ -1170,33 +1284,73 @@ async def view_user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def new_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка нового участника в чате"""
+    chat_id = str(update.effective_chat.id)
     for member in update.message.new_chat_members:
         if member.id != context.bot.id:  # Не сам бот
-            user_id = member.id
-            chat_id = str(update.effective_chat.id)
-
-            # Сохраняем базовую информацию
-            db.add_or_update_user(
-                user_id=user_id,
-                chat_id=chat_id,
-                username=member.username,
-                first_name=member.first_name
-            )
+            # Сохраняем базовую информацию (в БД - пачкой вместе с другими вступившими)
+            user_batcher.add(member.id, chat_id, member.username, member.first_name)
+            # Приветствие с предложением зарегистрироваться - через очередь отправки
+            welcome_queue.add(member.id, member.first_name)
 
-            # Отправляем приветствие с предложением зарегистрироваться
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=(
-                        f"👋 Привет, {member.first_name}!\n\n"
-                        f"Вы присоединились к чату, который использует нашего бота для рассылок.\n\n"
-                        f"Чтобы получать персонализированные рассылки, "
-                        f"пройдите быструю регистрацию:\n"
-                        f"/register"
-                    )
-                )
-            except Exception as e:
-                logger.warning(f"Could not send registration message to user {user_id}: {e}")
+
+# === ИМПОРТ ПОЛЬЗОВАТЕЛЕЙ ===
+# Bot API отдает файлы до 20 МБ; большие выгрузки - через python user_import.py
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024
+
+
+@admin_only
+async def import_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Начало импорта участников из файла"""
+    context.user_data['import_chat_id'] = context.args[0] if context.args else None
+
+    await update.message.reply_text(
+        "📥 <b>Импорт пользователей</b>\n\n"
+        "Отправьте файл CSV, JSON (массив объектов) или JSONL с колонками:\n"
+        "<code>user_id, chat_id, username, first_name, gender, age</code>\n\n"
+        "Обязателен только user_id. chat_id можно не указывать в файле, "
+        "если передать его командой: <code>/import -1001234567890</code>\n\n"
+        "Для отмены используйте /cancel",
+        parse_mode="HTML"
+    )
+    return IMPORT_FILE
+
+
+async def import_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Загрузка файла с пользователями"""
+    document = update.message.document
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await update.message.reply_text(
+            "❌ Файл больше 20 МБ - Telegram не даст боту его скачать.\n"
+            "Загрузите его на сервере: <code>python user_import.py файл.csv</code>",
+            parse_mode="HTML"
+        )
+        return ConversationHandler.END
+
+    data = await (await document.get_file()).download_as_bytearray()
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        await update.message.reply_text(
+            "❌ Файл должен быть в кодировке UTF-8. Отправьте другой файл:"
+        )
+        return IMPORT_FILE
+
+    importer = UserImport(context.user_data.pop('import_chat_id', None))
+    rows = importer.rows(io.StringIO(text, newline=""), importer.detect_format(document.file_name or ""))
+    # Разбор и запись идут в потоке БД пачками по IMPORT_BATCH_SIZE строк
+    try:
+        loaded = await db.aio.add_users_bulk(rows, batch_size=config.IMPORT_BATCH_SIZE)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ Не удалось разобрать файл: {e}\nОтправьте другой файл:")
+        return IMPORT_FILE
+
+    await update.message.reply_text(
+        f"✅ Импорт завершен\n\n"
+        f"Загружено: {loaded}\n"
+        f"Пропущено строк с ошибками: {importer.skipped}"
+    )
+    logger.info(f"Imported {loaded} users from {document.file_name} by {update.effective_user.id}")
+    return ConversationHandler.END
 
 
 # === ОТМЕНА ===
@@ -1208,47 +1362,35 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # === CALLBACK HANDLERS ===
+# Код действия в callback_data -> обработчик
+router.add("menu", show_main_menu)
+router.add("cb", create_broadcast_start)
+router.add("bcp", list_broadcasts)
+router.add("vb", view_broadcast)
+router.add("db", delete_broadcast)
+router.add("rp", pause_run)
+router.add("rr", resume_run)
+router.add("chats", manage_chats)
+router.add("ac", add_chat_start)
+router.add("ec", edit_chat)
+router.add("tc", toggle_chat)
+router.add("rc", remove_chat)
+router.add("admins", manage_admins)
+router.add("aa", add_admin_start)
+router.add("ra", remove_admin)
+router.add("stats", show_statistics)
+router.add("ustats", view_user_stats)
+router.add("help", show_help)
+
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик нажатий на кнопки"""
-    query = update.callback_query
-
-    if query.data == "main_menu":
-        await show_main_menu(update, context)
-    elif query.data == "create_broadcast":
-        await create_broadcast_start(update, context)
-    elif query.data == "list_broadcasts":
-        await list_broadcasts(update, context)
-    elif query.data == "manage_chats":
-        await manage_chats(update, context)
-    elif query.data == "manage_admins":
-        await manage_admins(update, context)
-    elif query.data == "add_admin":
-        return await add_admin_start(update, context)
-    elif query.data.startswith("remove_admin_"):
-        await remove_admin(update, context)
-    elif query.data == "statistics":
-        await show_statistics(update, context)
-    elif query.data == "user_stats":
-        await view_user_stats(update, context)
-    elif query.data == "help":
-        await show_help(update, context)
-    elif query.data.startswith("view_broadcast_"):
-        await view_broadcast(update, context)
-    elif query.data.startswith("delete_broadcast_"):
-        await delete_broadcast(update, context)
-    elif query.data.startswith("edit_chat_"):
-        await edit_chat(update, context)
-    elif query.data.startswith("toggle_") and not query.data.startswith("toggle_chat_"):
-        await toggle_chat(update, context)
-    elif query.data.startswith("remove_"):
-        await remove_chat(update, context)
-    elif query.data == "add_chat":
-        await add_chat_start(update, context)
+    return await router.dispatch(update, context)
 
 
 def main():
     """Запуск бота"""
-    global scheduler
+    global scheduler, link_tracker, user_batcher, welcome_queue
 
     # Проверка конфигурации
     if not config.BOT_TOKEN:
@@ -1260,20 +1402,43 @@ def main():
         return
 
     # Создаем приложение
-    application = Application.builder().token(config.BOT_TOKEN).build()
+    application = Application.builder().token(config.BOT_TOKEN).base_url(config.BOT_API_URL).build()
 
     # Создаем планировщик
     scheduler = BroadcastScheduler(application.bot, db)
     scheduler.start()
+    # Рассылки из БД, запланированные до перезапуска
+    scheduler.restore_broadcasts()
+
+    user_batcher = UserBatcher(
+        db,
+        batch_size=config.JOIN_BATCH_SIZE,
+        flush_interval=config.JOIN_FLUSH_INTERVAL
+    )
+    # Приветствия идут через движок рассылок: общий лимит скорости и пауза flood control
+    welcome_queue = WelcomeQueue(application.bot, scheduler.sender)
+
+    if config.LINK_TRACKING_BASE_URL:
+        link_tracker = LinkTracker(
+            db,
+            base_url=config.LINK_TRACKING_BASE_URL,
+            host=config.LINK_TRACKING_HOST,
+            port=config.LINK_TRACKING_PORT,
+            flush_interval=config.LINK_TRACKING_FLUSH_INTERVAL
+        )
 
     # === ОБРАБОТЧИКИ ===
 
     # Создание рассылки (ConversationHandler)
     broadcast_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(create_broadcast_start, pattern="^create_broadcast$")],
+        entry_points=[CallbackQueryHandler(create_broadcast_start, pattern=router.pattern("cb"))],
         states={
             BROADCAST_TITLE: [MessageHandler(filters.TEXT & ~filters.COMMAND, broadcast_title)],
-            BROADCAST_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, broadcast_text)],
+            BROADCAST_TEXT: [MessageHandler(
+                (filters.TEXT | filters.PHOTO | filters.VIDEO | filters.ANIMATION
+                 | filters.Document.ALL | filters.AUDIO | filters.VOICE) & ~filters.COMMAND,
+                broadcast_text
+            )],
             BROADCAST_CHATS: [
                 CallbackQueryHandler(toggle_chat_selection, pattern="^toggle_chat_"),
                 CallbackQueryHandler(chats_selected, pattern="^chats_selected$")
@@ -1296,7 +1461,7 @@ def main():
 
     # Добавление чата (ConversationHandler)
     add_chat_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(add_chat_start, pattern="^add_chat$")],
+        entry_points=[CallbackQueryHandler(add_chat_start, pattern=router.pattern("ac"))],
         states={
             ADD_CHAT_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_chat_id)],
             ADD_CHAT_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_chat_name)]
@@ -1316,13 +1481,22 @@ def main():
 
     # Добавление администратора (ConversationHandler)
     add_admin_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(add_admin_start, pattern="^add_admin$")],
+        entry_points=[CallbackQueryHandler(add_admin_start, pattern=router.pattern("aa"))],
         states={
             ADD_ADMIN_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_admin_id)]
         },
         fallbacks=[CommandHandler("cancel", cancel)]
     )
 
+    # Импорт пользователей из файла (ConversationHandler)
+    import_conv = ConversationHandler(
+        entry_points=[CommandHandler("import", import_start)],
+        states={
+            IMPORT_FILE: [MessageHandler(filters.Document.ALL, import_file)]
+        },
+        fallbacks=[CommandHandler("cancel", cancel)]
+    )
+
     # Команды
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", show_help))
@@ -1333,6 +1507,7 @@ def main():
     application.add_handler(add_chat_conv)
     application.add_handler(register_conv)
     application.add_handler(add_admin_conv)
+    application.add_handler(import_conv)
 
     # Обработчик новых участников чата
     application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, new_chat_member))
@@ -1352,11 +1527,44 @@ def main():
         await app.bot.set_my_commands(commands)
         logger.info("Menu commands set up")
 
-    application.post_init = setup_commands
+    async def post_init(app):
+        await setup_commands(app)
+        # Эндпоинт /metrics и замер задержки цикла событий (если METRICS_PORT задан)
+        metrics.start_server()
+        global loop_monitor
+        loop_monitor = metrics.start_loop_monitor()
+        user_batcher.start()
+        scheduler.start_rate_sharing()
+        welcome_queue.start()
+        if link_tracker:
+            await link_tracker.start()
+
+    async def post_shutdown(app):
+        if loop_monitor:
+            loop_monitor.cancel()
+        await welcome_queue.stop()
+        await scheduler.stop_rate_sharing()
+        await user_batcher.close()
+        if link_tracker:
+            await link_tracker.stop()
+
+    application.post_init = post_init
+    application.post_shutdown = post_shutdown
 
     # Запуск бота
-    logger.info("Бот запущен!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if config.WEBHOOK_URL:
+        logger.info(f"Бот запущен (webhook, порт {config.WEBHOOK_PORT})!")
+        application.run_webhook(
+            listen=config.WEBHOOK_LISTEN,
+            port=config.WEBHOOK_PORT,
+            url_path=config.WEBHOOK_PATH,
+            webhook_url=f"{config.WEBHOOK_URL.rstrip('/')}/{config.WEBHOOK_PATH}",
+            secret_token=config.WEBHOOK_SECRET or None,
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        logger.info("Бот запущен!")
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":
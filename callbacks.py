@@ -0,0 +1,54 @@
+import re
+from typing import Awaitable, Callable, Dict
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+# Telegram ограничивает callback_data 64 байтами
+MAX_CALLBACK_DATA = 64
+
+
+class CallbackRouter:
+    """Маршрутизатор нажатий на кнопки.
+
+    callback_data имеет вид "код|арг1|арг2": короткий код действия и
+    упакованные аргументы. Обработчик находится по коду одним поиском в
+    словаре и получает аргументы строками: handler(update, context, *args).
+    """
+
+    SEPARATOR = "|"
+
+    def __init__(self):
+        self._routes: Dict[str, Callable[..., Awaitable]] = {}
+
+    def add(self, code: str, handler: Callable[..., Awaitable]):
+        if self.SEPARATOR in code:
+            raise ValueError(f"Callback code must not contain '{self.SEPARATOR}': {code}")
+        if code in self._routes:
+            raise ValueError(f"Callback code already registered: {code}")
+        self._routes[code] = handler
+
+    def data(self, code: str, *args) -> str:
+        """Собрать callback_data для кнопки"""
+        if code not in self._routes:
+            raise KeyError(f"Unknown callback code: {code}")
+        data = self.SEPARATOR.join((code, *map(str, args)))
+        if len(data.encode()) > MAX_CALLBACK_DATA:
+            raise ValueError(f"callback_data longer than {MAX_CALLBACK_DATA} bytes: {data}")
+        return data
+
+    def pattern(self, code: str) -> str:
+        """Регулярное выражение для CallbackQueryHandler(pattern=...) на это действие"""
+        return f"^{re.escape(code)}(\\{self.SEPARATOR}|$)"
+
+    def resolve(self, data: str):
+        """Обработчик и аргументы по callback_data (None, если код неизвестен)"""
+        code, _, rest = data.partition(self.SEPARATOR)
+        return self._routes.get(code), rest.split(self.SEPARATOR) if rest else ()
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        handler, args = self.resolve(update.callback_query.data)
+        if handler is None:
+            await update.callback_query.answer()
+            return None
+        return await handler(update, context, *args)
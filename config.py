@@ -14,6 +14,10 @@ except ImportError:
 # Токен бота (получить у @BotFather)
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 
+# Адрес Bot API (к нему добавляется токен): свой сервер telegram-bot-api
+# или заглушка из benchmarks/delivery.py
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org/bot")
+
 # ID первого администратора (ваш Telegram ID)
 # Получить можно у @userinfobot
 FIRST_ADMIN_ID = int(os.getenv("FIRST_ADMIN_ID", "0"))
@@ -21,5 +25,80 @@ FIRST_ADMIN_ID = int(os.getenv("FIRST_ADMIN_ID", "0"))
 # Путь к базе данных
 DATABASE_PATH = os.getenv("DATABASE_PATH", "broadcast_bot.db")
 
+# Количество соединений с БД (и потоков для асинхронных запросов)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+# Сколько секунд ждать, пока другой процесс освободит базу для записи
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "30"))
+
+# Сколько секунд кэш списка администраторов считается актуальным
+ADMIN_CACHE_TTL = float(os.getenv("ADMIN_CACHE_TTL", "300"))
+
 # Часовой пояс
 TIMEZONE = os.getenv("TIMEZONE", "Europe/Moscow")
+
+# Режим webhook вместо polling: публичный HTTPS-адрес бота (например, https://bot.example.com)
+# Пусто - бот работает через polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+# На Render/Railway порт приходит в переменной PORT
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+# Секрет для проверки, что запросы пришли от Telegram
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+# Параметры движка доставки рассылок
+# Количество параллельных воркеров отправки
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "20"))
+# Глобальный лимит Telegram: ~30 сообщений в секунду
+SEND_RATE_LIMIT = float(os.getenv("SEND_RATE_LIMIT", "30"))
+# Минимальный интервал между сообщениями в один чат (секунды)
+SEND_PER_CHAT_INTERVAL = float(os.getenv("SEND_PER_CHAT_INTERVAL", "1.0"))
+# Повторы при временных ошибках Telegram (TimedOut, NetworkError, RetryAfter)
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "5"))
+# База и потолок экспоненциальной задержки между повторами (секунды)
+SEND_BACKOFF_BASE = float(os.getenv("SEND_BACKOFF_BASE", "1.0"))
+SEND_BACKOFF_MAX = float(os.getenv("SEND_BACKOFF_MAX", "30"))
+# Журнал доставки пишется пачками: не реже раза в интервал (секунды)
+DELIVERY_LOG_BATCH_SIZE = int(os.getenv("DELIVERY_LOG_BATCH_SIZE", "500"))
+DELIVERY_LOG_FLUSH_INTERVAL = float(os.getenv("DELIVERY_LOG_FLUSH_INTERVAL", "1.0"))
+# Получатели берутся из очереди outbox пачками по столько сообщений
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+
+# Процессы-отправители (worker.py). 0 - рассылки отправляет сам бот;
+# N - бот только ставит прогоны в очередь outbox, отправляют N процессов worker.py
+SENDER_PROCESSES = int(os.getenv("SENDER_PROCESSES", "0"))
+# Аренда взятых сообщений: если отправитель не продлил ее за это время (упал),
+# сообщения снова выдаются из очереди
+SENDER_LEASE_TIMEOUT = float(os.getenv("SENDER_LEASE_TIMEOUT", "300"))
+# Как часто процессы отмечаются в БД и бот проверяет готовность прогона (секунды)
+SENDER_HEARTBEAT_INTERVAL = float(os.getenv("SENDER_HEARTBEAT_INTERVAL", "2"))
+# Часть SEND_RATE_LIMIT, которую бот оставляет себе для приветствий при SENDER_PROCESSES > 0;
+# процессы worker.py делят между собой остаток
+WELCOME_RATE_LIMIT = float(os.getenv("WELCOME_RATE_LIMIT", "2"))
+
+# Вступления в чаты: новые участники пишутся в БД пачкой до JOIN_BATCH_SIZE строк
+# или раз в JOIN_FLUSH_INTERVAL секунд
+JOIN_BATCH_SIZE = int(os.getenv("JOIN_BATCH_SIZE", "200"))
+JOIN_FLUSH_INTERVAL = float(os.getenv("JOIN_FLUSH_INTERVAL", "0.5"))
+
+# Массовый импорт пользователей (/import, user_import.py): строк на транзакцию
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "50000"))
+
+# Политика пропущенных запусков рассылок (например, после перезапуска)
+# Сколько секунд после запланированного времени запуск еще выполняется; пусто или 0 - всегда
+JOB_MISFIRE_GRACE_TIME = int(os.getenv("JOB_MISFIRE_GRACE_TIME", "600") or 0) or None
+# Объединять несколько пропущенных запусков периодической рассылки в один
+JOB_COALESCE = os.getenv("JOB_COALESCE", "true").lower() in ("1", "true", "yes")
+
+# Трекинг кликов: публичный адрес сервера коротких ссылок (например, https://bot.example.com/l)
+# Пусто - ссылки в рассылках не заменяются
+LINK_TRACKING_BASE_URL = os.getenv("LINK_TRACKING_BASE_URL", "")
+LINK_TRACKING_HOST = os.getenv("LINK_TRACKING_HOST", "0.0.0.0")
+LINK_TRACKING_PORT = int(os.getenv("LINK_TRACKING_PORT", "8080"))
+# Как часто накопленные клики записываются в БД (секунды)
+LINK_TRACKING_FLUSH_INTERVAL = float(os.getenv("LINK_TRACKING_FLUSH_INTERVAL", "10"))
+
+# Метрики Prometheus (нужен пакет prometheus_client): порт HTTP-эндпоинта /metrics; 0 - выключены.
+# Процессы worker.py слушают следующие порты: METRICS_PORT + 1, + 2, ...
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
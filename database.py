@@ -1,20 +1,132 @@
+import asyncio
+import queue
 import sqlite3
+import threading
+import time
 import json
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Dict, Optional
+from functools import partial
+from itertools import islice
+from typing import AsyncIterator, Iterable, List, Dict, Optional
+
+import metrics
+
+# Настройки соединения: WAL позволяет читать во время записи,
+# synchronous=NORMAL в режиме WAL безопасен и не делает fsync на каждый коммит
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -20000",
+    "PRAGMA temp_store = MEMORY",
+)
+
+# Размер кэша подготовленных выражений на соединение
+STATEMENT_CACHE_SIZE = 256
+
+# Индексы: (имя, таблица, колонки)
+INDEXES = (
+    # Пользователи чата с фильтрами по полу/возрасту; покрывает COUNT и выбор user_id
+    ("idx_users_chat", "users", "chat_id, gender, age, user_id"),
+    ("idx_statistics_broadcast", "statistics", "broadcast_id"),
+    # Постраничный список рассылок: ключ (created_at, id), с фильтром по статусу и без
+    ("idx_broadcasts_status", "broadcasts", "status, created_at, id"),
+    ("idx_broadcasts_created", "broadcasts", "created_at, id"),
+    ("idx_link_tracking_broadcast", "link_tracking", "broadcast_id"),
+    ("idx_deliveries_run", "deliveries", "run_id, user_id"),
+    ("idx_deliveries_broadcast", "deliveries", "broadcast_id, status"),
+    # Выдача очереди отправки и продление аренды отправителем
+    ("idx_outbox_claim", "outbox", "run_id, status, lease_until"),
+    ("idx_outbox_worker", "outbox", "worker_id, status"),
+)
 
 
 class Database:
-    def __init__(self, db_path="broadcast_bot.db"):
+    def __init__(self, db_path="broadcast_bot.db", pool_size: int = 4,
+                 admin_cache_ttl: float = 300, busy_timeout: float = 30):
         self.db_path = db_path
+        self.pool_size = pool_size
+        # Сколько секунд ждать блокировку записи (бот и процессы worker.py пишут в одну базу)
+        self.busy_timeout = busy_timeout
+        self._pool = queue.LifoQueue()
+        self._created = 0
+        self._pool_lock = threading.Lock()
+        self._aio = None
+        # Кэш таблицы admins: user_id -> role
+        self.admin_cache_ttl = admin_cache_ttl
+        self._admin_roles: Optional[Dict[int, str]] = None
+        self._admin_loaded_at = 0.0
         self.init_db()
+        self._get_admin_roles()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._pool_lock:
+            create = self._created < self.pool_size
+            if create:
+                self._created += 1
+        if create:
+            return self._connect()
+        return self._pool.get()
+
+    @contextmanager
+    def connection(self):
+        """Соединение из пула: коммит при успехе, откат при ошибке"""
+        conn = self._acquire()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._pool.put(conn)
 
     def get_connection(self):
-        return sqlite3.connect(self.db_path)
+        """Отдельное соединение вне пула (для скриптов и миграций)"""
+        return self._connect()
+
+    @property
+    def aio(self) -> "AsyncDatabase":
+        """Асинхронный доступ к тем же методам (запросы выполняются в пуле потоков)"""
+        if self._aio is None:
+            self._aio = AsyncDatabase(self)
+        return self._aio
+
+    def close(self):
+        """Закрыть все соединения пула"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        self._created = 0
+        if self._aio is not None:
+            self._aio.shutdown()
+            self._aio = None
 
     def init_db(self):
         """Инициализация базы данных"""
-        conn = self.get_connection()
+        with self.connection() as conn:
+            self._create_schema(conn)
+
+    def _create_schema(self, conn):
         cursor = conn.cursor()
 
         # Таблица администраторов
@@ -110,6 +222,63 @@ class Database:
             )
         """)
 
+        # Прогоны рассылок: один прогон - одна отправка всей аудитории
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS broadcast_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                broadcast_id INTEGER,
+                repeat_number INTEGER,
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP,
+                sent_count INTEGER DEFAULT 0,
+                failed_count INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'running',
+                FOREIGN KEY (broadcast_id) REFERENCES broadcasts(id)
+            )
+        """)
+
+        # Журнал доставки: строка на каждого получателя прогона
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS deliveries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id INTEGER,
+                broadcast_id INTEGER,
+                user_id INTEGER,
+                status TEXT,
+                error_code TEXT,
+                message_id INTEGER,
+                latency_ms INTEGER,
+                sent_at TIMESTAMP,
+                FOREIGN KEY (run_id) REFERENCES broadcast_runs(id)
+            )
+        """)
+
+        # Очередь отправки (outbox): строка на получателя прогона.
+        # status: queued -> leased (взята отправителем до lease_until) -> sent/failed
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id INTEGER,
+                user_id INTEGER,
+                status TEXT DEFAULT 'queued',
+                worker_id TEXT,
+                lease_until REAL,
+                attempts INTEGER DEFAULT 0,
+                UNIQUE(run_id, user_id),
+                FOREIGN KEY (run_id) REFERENCES broadcast_runs(id)
+            )
+        """)
+
+        # Живые процессы-отправители: общий лимит скорости делится между ними
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sender_workers (
+                worker_id TEXT PRIMARY KEY,
+                heartbeat_at REAL,
+                paused_until REAL,
+                reserved_rate REAL DEFAULT 0
+            )
+        """)
+
         # Обновляем таблицу broadcasts - добавляем поля для фильтров
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS broadcasts_new (
@@ -149,143 +318,138 @@ class Database:
                 cursor.execute("DROP TABLE broadcasts")
                 cursor.execute("ALTER TABLE broadcasts_new RENAME TO broadcasts")
 
-        conn.commit()
-        conn.close()
+        # Миграция: исходное сообщение для медиа-рассылок (отправляются через copyMessage)
+        cursor.execute("PRAGMA table_info(broadcasts)")
+        columns = [row[1] for row in cursor.fetchall()]
+        if 'source_chat_id' not in columns:
+            cursor.execute("ALTER TABLE broadcasts ADD COLUMN source_chat_id INTEGER")
+        if 'source_message_id' not in columns:
+            cursor.execute("ALTER TABLE broadcasts ADD COLUMN source_message_id INTEGER")
+
+        # Миграция: индексы (создаются после всех таблиц и миграций)
+        self.create_indexes(conn)
+
+    @staticmethod
+    def create_indexes(conn):
+        """Создать недостающие индексы из INDEXES"""
+        for name, table, columns in INDEXES:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({columns})")
+        conn.execute("PRAGMA optimize")
 
     # === АДМИНИСТРАТОРЫ ===
+    def _get_admin_roles(self) -> Dict[int, str]:
+        """Роли администраторов из кэша; перечитываются из БД по истечении TTL"""
+        roles = self._admin_roles
+        if roles is None or time.monotonic() - self._admin_loaded_at > self.admin_cache_ttl:
+            with self.connection() as conn:
+                roles = dict(conn.execute("SELECT user_id, role FROM admins").fetchall())
+            self._admin_roles = roles
+            self._admin_loaded_at = time.monotonic()
+        return roles
+
+    def invalidate_admin_cache(self):
+        self._admin_roles = None
+
     def add_admin(self, user_id: int, username: str = None, role: str = 'admin'):
         """Добавить администратора. role: 'owner' (главный) или 'admin' (обычный)"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
         try:
-            cursor.execute("INSERT OR IGNORE INTO admins (user_id, username, role) VALUES (?, ?, ?)",
-                          (user_id, username, role))
-            conn.commit()
+            with self.connection() as conn:
+                conn.execute("INSERT OR IGNORE INTO admins (user_id, username, role) VALUES (?, ?, ?)",
+                             (user_id, username, role))
             return True
         except Exception as e:
             print(f"Error adding admin: {e}")
             return False
         finally:
-            conn.close()
+            self.invalidate_admin_cache()
 
     def is_admin(self, user_id: int) -> bool:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM admins WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return result is not None
+        return user_id in self._get_admin_roles()
 
     def get_admins(self) -> List[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id, username, role, added_at FROM admins")
-        admins = [{"user_id": row[0], "username": row[1], "role": row[2], "added_at": row[3]}
-                 for row in cursor.fetchall()]
-        conn.close()
-        return admins
+        with self.connection() as conn:
+            rows = conn.execute("SELECT user_id, username, role, added_at FROM admins").fetchall()
+        return [{"user_id": row[0], "username": row[1], "role": row[2], "added_at": row[3]}
+                for row in rows]
 
     def is_owner(self, user_id: int) -> bool:
         """Проверить является ли пользователь главным администратором"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT role FROM admins WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return result is not None and result[0] == 'owner'
+        return self._get_admin_roles().get(user_id) == 'owner'
 
     def remove_admin(self, user_id: int):
         """Удалить администратора"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
         try:
-            cursor.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
-            conn.commit()
+            with self.connection() as conn:
+                conn.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
             return True
         except Exception as e:
             print(f"Error removing admin: {e}")
             return False
         finally:
-            conn.close()
+            self.invalidate_admin_cache()
 
     # === ЦЕЛЕВЫЕ ЧАТЫ ===
     def add_target_chat(self, chat_id: str, chat_name: str, chat_type: str):
-        conn = self.get_connection()
-        cursor = conn.cursor()
         try:
-            cursor.execute("""
-                INSERT OR REPLACE INTO target_chats (chat_id, chat_name, chat_type)
-                VALUES (?, ?, ?)
-            """, (chat_id, chat_name, chat_type))
-            conn.commit()
+            with self.connection() as conn:
+                conn.execute("""
+                    INSERT OR REPLACE INTO target_chats (chat_id, chat_name, chat_type)
+                    VALUES (?, ?, ?)
+                """, (chat_id, chat_name, chat_type))
             return True
         except Exception as e:
             print(f"Error adding target chat: {e}")
             return False
-        finally:
-            conn.close()
 
     def get_target_chats(self, active_only=True) -> List[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
         query = "SELECT id, chat_id, chat_name, chat_type, is_active FROM target_chats"
         if active_only:
             query += " WHERE is_active = 1"
-        cursor.execute(query)
-        chats = [{"id": row[0], "chat_id": row[1], "chat_name": row[2],
+        with self.connection() as conn:
+            rows = conn.execute(query).fetchall()
+        return [{"id": row[0], "chat_id": row[1], "chat_name": row[2],
                  "chat_type": row[3], "is_active": row[4]}
-                for row in cursor.fetchall()]
-        conn.close()
-        return chats
+                for row in rows]
 
     def toggle_target_chat(self, chat_id: str):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE target_chats
-            SET is_active = CASE WHEN is_active = 1 THEN 0 ELSE 1 END
-            WHERE chat_id = ?
-        """, (chat_id,))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            conn.execute("""
+                UPDATE target_chats
+                SET is_active = CASE WHEN is_active = 1 THEN 0 ELSE 1 END
+                WHERE chat_id = ?
+            """, (chat_id,))
 
     def remove_target_chat(self, chat_id: str):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM target_chats WHERE chat_id = ?", (chat_id,))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            conn.execute("DELETE FROM target_chats WHERE chat_id = ?", (chat_id,))
 
     # === РАССЫЛКИ ===
     def create_broadcast(self, title: str, message_text: str, target_chats: List[str],
                         scheduled_time: datetime, frequency: str = "once",
                         repeat_count: int = 1, gender_filter: str = None,
-                        age_min: int = None, age_max: int = None) -> int:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO broadcasts (title, message_text, target_chats, scheduled_time,
-                                  frequency, repeat_count, gender_filter, age_min, age_max)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (title, message_text, json.dumps(target_chats),
-              scheduled_time.isoformat(), frequency, repeat_count,
-              gender_filter, age_min, age_max))
-        broadcast_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return broadcast_id
+                        age_min: int = None, age_max: int = None,
+                        source_chat_id: int = None, source_message_id: int = None) -> int:
+        """source_chat_id/source_message_id - исходное сообщение с медиа; тогда
+        message_text - его подпись"""
+        with self.connection() as conn:
+            cursor = conn.execute("""
+                INSERT INTO broadcasts (title, message_text, target_chats, scheduled_time,
+                                      frequency, repeat_count, gender_filter, age_min, age_max,
+                                      source_chat_id, source_message_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (title, message_text, json.dumps(target_chats),
+                  scheduled_time.isoformat(), frequency, repeat_count,
+                  gender_filter, age_min, age_max, source_chat_id, source_message_id))
+            return cursor.lastrowid
 
     def get_broadcast(self, broadcast_id: int) -> Optional[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT id, title, message_text, target_chats, scheduled_time,
-                   frequency, repeat_count, current_repeat, status, created_at,
-                   gender_filter, age_min, age_max
-            FROM broadcasts WHERE id = ?
-        """, (broadcast_id,))
-        row = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            row = conn.execute("""
+                SELECT id, title, message_text, target_chats, scheduled_time,
+                       frequency, repeat_count, current_repeat, status, created_at,
+                       gender_filter, age_min, age_max, source_chat_id, source_message_id
+                FROM broadcasts WHERE id = ?
+            """, (broadcast_id,)).fetchone()
 
         if row:
             return {
@@ -293,136 +457,485 @@ class Database:
                 "target_chats": json.loads(row[3]), "scheduled_time": row[4],
                 "frequency": row[5], "repeat_count": row[6],
                 "current_repeat": row[7], "status": row[8], "created_at": row[9],
-                "gender_filter": row[10], "age_min": row[11], "age_max": row[12]
+                "gender_filter": row[10], "age_min": row[11], "age_max": row[12],
+                "source_chat_id": row[13], "source_message_id": row[14]
             }
         return None
 
     def get_broadcasts(self, status: str = None) -> List[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
         query = """
             SELECT id, title, scheduled_time, frequency, repeat_count,
                    current_repeat, status
             FROM broadcasts
         """
+        params = []
         if status:
-            query += f" WHERE status = '{status}'"
+            query += " WHERE status = ?"
+            params.append(status)
         query += " ORDER BY created_at DESC"
 
-        cursor.execute(query)
-        broadcasts = [{"id": row[0], "title": row[1], "scheduled_time": row[2],
-                      "frequency": row[3], "repeat_count": row[4],
-                      "current_repeat": row[5], "status": row[6]}
-                     for row in cursor.fetchall()]
-        conn.close()
-        return broadcasts
+        with self.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+        return [{"id": row[0], "title": row[1], "scheduled_time": row[2],
+                 "frequency": row[3], "repeat_count": row[4],
+                 "current_repeat": row[5], "status": row[6]}
+                for row in rows]
+
+    def get_broadcasts_page(self, status: str = None, cursor: tuple = None,
+                            direction: str = "next", limit: int = 10) -> Dict:
+        """Страница рассылок (новые сверху) с keyset-пагинацией по (created_at, id).
+
+        cursor - (created_at, id) крайней рассылки предыдущей страницы:
+        direction="next" - более старые после нее, "prev" - более новые до нее.
+        Возвращает {"items": [...], "has_next": bool, "has_prev": bool}.
+        """
+        query = """
+            SELECT id, title, scheduled_time, frequency, repeat_count,
+                   current_repeat, status, created_at
+            FROM broadcasts
+        """
+        conditions = []
+        params = []
+        if status:
+            conditions.append("status = ?")
+            params.append(status)
+        if cursor:
+            conditions.append("(created_at, id) < (?, ?)" if direction == "next"
+                              else "(created_at, id) > (?, ?)")
+            params.extend(cursor)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        order = "DESC" if direction == "next" else "ASC"
+        query += f" ORDER BY created_at {order}, id {order} LIMIT ?"
+        # Одна лишняя строка показывает, есть ли следующая страница
+        params.append(limit + 1)
+
+        with self.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if direction != "next":
+            rows.reverse()
+
+        items = [{"id": row[0], "title": row[1], "scheduled_time": row[2],
+                  "frequency": row[3], "repeat_count": row[4],
+                  "current_repeat": row[5], "status": row[6], "created_at": row[7]}
+                 for row in rows]
+        if direction == "next":
+            return {"items": items, "has_next": has_more, "has_prev": cursor is not None}
+        return {"items": items, "has_next": True, "has_prev": has_more}
+
+    def update_broadcast_text(self, broadcast_id: int, message_text: str):
+        with self.connection() as conn:
+            conn.execute("UPDATE broadcasts SET message_text = ? WHERE id = ?",
+                         (message_text, broadcast_id))
 
     def update_broadcast_status(self, broadcast_id: int, status: str):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE broadcasts SET status = ? WHERE id = ?",
-                      (status, broadcast_id))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            conn.execute("UPDATE broadcasts SET status = ? WHERE id = ?",
+                         (status, broadcast_id))
 
     def increment_broadcast_repeat(self, broadcast_id: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE broadcasts
-            SET current_repeat = current_repeat + 1
-            WHERE id = ?
-        """, (broadcast_id,))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            conn.execute("""
+                UPDATE broadcasts
+                SET current_repeat = current_repeat + 1
+                WHERE id = ?
+            """, (broadcast_id,))
 
     def delete_broadcast(self, broadcast_id: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM broadcasts WHERE id = ?", (broadcast_id,))
-        cursor.execute("DELETE FROM statistics WHERE broadcast_id = ?", (broadcast_id,))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            conn.execute("DELETE FROM broadcasts WHERE id = ?", (broadcast_id,))
+            conn.execute("DELETE FROM statistics WHERE broadcast_id = ?", (broadcast_id,))
+            conn.execute("DELETE FROM deliveries WHERE broadcast_id = ?", (broadcast_id,))
+            conn.execute("""
+                DELETE FROM outbox
+                WHERE run_id IN (SELECT id FROM broadcast_runs WHERE broadcast_id = ?)
+            """, (broadcast_id,))
+            conn.execute("DELETE FROM broadcast_runs WHERE broadcast_id = ?", (broadcast_id,))
+            conn.execute("DELETE FROM link_tracking WHERE broadcast_id = ?", (broadcast_id,))
 
     # === СТАТИСТИКА ===
-    def add_broadcast_stat(self, broadcast_id: int, chat_id: str):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO statistics (broadcast_id, chat_id, sent_at)
-            VALUES (?, ?, ?)
-        """, (broadcast_id, chat_id, datetime.now().isoformat()))
-        conn.commit()
-        conn.close()
-
+    # Отправки считаются по deliveries/broadcast_runs; в statistics остались
+    # только просмотры и строки рассылок, отправленных до журнала доставки
     def get_broadcast_stats(self, broadcast_id: int) -> Dict:
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        """Отправлено/доставлено - по журналу доставки, просмотры - по statistics,
+        клики - по коротким ссылкам"""
+        with self.connection() as conn:
+            sent_row = conn.execute("""
+                SELECT COUNT(*) as total_sent,
+                       SUM(status = 'sent') as delivered
+                FROM deliveries WHERE broadcast_id = ?
+            """, (broadcast_id,)).fetchone()
+            row = conn.execute("""
+                SELECT (SELECT SUM(views) FROM statistics WHERE broadcast_id = ?) as total_views,
+                       (SELECT SUM(clicks) FROM link_tracking WHERE broadcast_id = ?) as total_clicks
+            """, (broadcast_id, broadcast_id)).fetchone()
 
-        cursor.execute("""
-            SELECT COUNT(*) as total_sent,
-                   SUM(delivered) as delivered,
-                   SUM(views) as total_views,
-                   SUM(clicks) as total_clicks
-            FROM statistics WHERE broadcast_id = ?
-        """, (broadcast_id,))
+        return {
+            "total_sent": sent_row[0] or 0,
+            "delivered": sent_row[1] or 0,
+            "total_views": row[0] or 0,
+            "total_clicks": row[1] or 0
+        }
 
-        row = cursor.fetchone()
-        conn.close()
+    def get_statistics_summary(self) -> Dict:
+        """Общая статистика по всем рассылкам одним запросом (по счетчикам прогонов)"""
+        with self.connection() as conn:
+            row = conn.execute("""
+                SELECT (SELECT COUNT(*) FROM broadcasts),
+                       (SELECT SUM(sent_count + failed_count) FROM broadcast_runs),
+                       (SELECT SUM(sent_count) FROM broadcast_runs),
+                       (SELECT SUM(clicks) FROM link_tracking)
+            """).fetchone()
 
         return {
-            "total_sent": row[0] or 0,
-            "delivered": row[1] or 0,
-            "total_views": row[2] or 0,
+            "total_broadcasts": row[0] or 0,
+            "total_sent": row[1] or 0,
+            "delivered": row[2] or 0,
             "total_clicks": row[3] or 0
         }
 
+    # === ТРЕКИНГ ССЫЛОК ===
+    def add_tracked_links(self, broadcast_id: int, links: List[tuple]):
+        """Сохранить короткие ссылки рассылки: links - [(original_url, short_code)]"""
+        with self.connection() as conn:
+            conn.executemany("""
+                INSERT INTO link_tracking (broadcast_id, original_url, short_code)
+                VALUES (?, ?, ?)
+            """, [(broadcast_id, url, code) for url, code in links])
+
+    def get_tracked_links(self) -> Dict[str, str]:
+        """Все короткие ссылки: short_code -> original_url"""
+        with self.connection() as conn:
+            rows = conn.execute("SELECT short_code, original_url FROM link_tracking").fetchall()
+        return dict(rows)
+
+    def add_link_clicks(self, clicks: Dict[str, int]):
+        """Пакетно прибавить клики: clicks - short_code -> количество"""
+        with self.connection() as conn:
+            conn.executemany(
+                "UPDATE link_tracking SET clicks = clicks + ? WHERE short_code = ?",
+                [(count, code) for code, count in clicks.items()]
+            )
+
     def record_click(self, broadcast_id: int, chat_id: str):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE statistics
-            SET clicks = clicks + 1
-            WHERE broadcast_id = ? AND chat_id = ?
-        """, (broadcast_id, chat_id))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            conn.execute("""
+                UPDATE statistics
+                SET clicks = clicks + 1
+                WHERE broadcast_id = ? AND chat_id = ?
+            """, (broadcast_id, chat_id))
+
+    # === ПРОГОНЫ И ЖУРНАЛ ДОСТАВКИ ===
+    def create_run(self, broadcast_id: int, repeat_number: int) -> int:
+        """Начать прогон рассылки"""
+        with self.connection() as conn:
+            cursor = conn.execute("""
+                INSERT INTO broadcast_runs (broadcast_id, repeat_number, started_at)
+                VALUES (?, ?, ?)
+            """, (broadcast_id, repeat_number, datetime.now().isoformat()))
+            return cursor.lastrowid
+
+    def get_open_run(self, broadcast_id: int) -> Optional[Dict]:
+        """Незавершенный прогон рассылки (прерванный перезапуском, ошибкой или на паузе)"""
+        with self.connection() as conn:
+            row = conn.execute("""
+                SELECT id, repeat_number, status FROM broadcast_runs
+                WHERE broadcast_id = ? AND status IN ('running', 'paused')
+                ORDER BY id DESC LIMIT 1
+            """, (broadcast_id,)).fetchone()
+        if row:
+            return {"id": row[0], "repeat_number": row[1], "status": row[2]}
+        return None
+
+    def get_open_run_broadcasts(self) -> List[int]:
+        """ID рассылок с незавершенными прогонами"""
+        with self.connection() as conn:
+            rows = conn.execute("""
+                SELECT DISTINCT broadcast_id FROM broadcast_runs
+                WHERE status IN ('running', 'paused')
+            """).fetchall()
+        return [row[0] for row in rows]
+
+    def set_run_paused(self, run_id: int, paused: bool) -> bool:
+        """Приостановить или продолжить прогон: отправители перестают брать его очередь.
+
+        Уже взятые в отправку сообщения дойдут. False - прогон уже завершен.
+        """
+        with self.connection() as conn:
+            cursor = conn.execute("""
+                UPDATE broadcast_runs SET status = ?
+                WHERE id = ? AND status IN ('running', 'paused')
+            """, ("paused" if paused else "running", run_id))
+            return cursor.rowcount > 0
+
+    def get_run_status(self, run_id: int) -> Optional[str]:
+        with self.connection() as conn:
+            row = conn.execute("SELECT status FROM broadcast_runs WHERE id = ?", (run_id,)).fetchone()
+        return row[0] if row else None
+
+    def finish_run(self, run_id: int) -> Dict:
+        """Завершить прогон: итоги по журналу доставки и +1 повтор рассылки одной транзакцией.
+
+        Очередь outbox прогона больше не нужна и удаляется. Возвращает {"sent", "failed"}.
+        """
+        with self.connection() as conn:
+            conn.execute("""
+                UPDATE broadcast_runs
+                SET finished_at = ?,
+                    status = 'done',
+                    sent_count = (SELECT COUNT(*) FROM deliveries
+                                  WHERE run_id = ? AND status = 'sent'),
+                    failed_count = (SELECT COUNT(*) FROM deliveries
+                                    WHERE run_id = ? AND status = 'failed')
+                WHERE id = ?
+            """, (datetime.now().isoformat(), run_id, run_id, run_id))
+            conn.execute("""
+                UPDATE broadcasts
+                SET current_repeat = current_repeat + 1
+                WHERE id = (SELECT broadcast_id FROM broadcast_runs WHERE id = ?)
+            """, (run_id,))
+            conn.execute("DELETE FROM outbox WHERE run_id = ?", (run_id,))
+            row = conn.execute(
+                "SELECT sent_count, failed_count FROM broadcast_runs WHERE id = ?", (run_id,)
+            ).fetchone()
+        return {"sent": row[0], "failed": row[1]} if row else {"sent": 0, "failed": 0}
+
+    def fail_run(self, run_id: int):
+        """Закрыть прогон после ошибки: отправители перестают его брать, очередь outbox удаляется.
+
+        Повтор рассылки не засчитывается; счетчики прогона уже ведет журнал доставки.
+        """
+        with self.connection() as conn:
+            conn.execute("""
+                UPDATE broadcast_runs SET finished_at = ?, status = 'failed'
+                WHERE id = ? AND status IN ('running', 'paused')
+            """, (datetime.now().isoformat(), run_id))
+            conn.execute("DELETE FROM outbox WHERE run_id = ?", (run_id,))
+
+    def add_deliveries(self, rows: List[tuple], run_id: int = None):
+        """Пакетная запись журнала доставки одной транзакцией.
+
+        rows: (run_id, broadcast_id, user_id, status, error_code, message_id, latency_ms, sent_at)
+        run_id: прогон, чьи счетчики sent_count/failed_count увеличиваются
+        Вместе с журналом те же получатели отмечаются в outbox (ack).
+        """
+        with self.connection() as conn:
+            conn.executemany("""
+                INSERT INTO deliveries (run_id, broadcast_id, user_id, status, error_code,
+                                        message_id, latency_ms, sent_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            conn.executemany("""
+                UPDATE outbox SET status = ?, lease_until = NULL
+                WHERE run_id = ? AND user_id = ?
+            """, ((row[3], row[0], row[2]) for row in rows))
+            if run_id is not None:
+                # Счетчики прогона обновляются вместе с журналом - сводка читает их без подсчета строк
+                sent = sum(1 for row in rows if row[3] == "sent")
+                conn.execute("""
+                    UPDATE broadcast_runs
+                    SET sent_count = sent_count + ?,
+                        failed_count = failed_count + ?
+                    WHERE id = ?
+                """, (sent, len(rows) - sent, run_id))
+
+    # === ОЧЕРЕДЬ ОТПРАВКИ (outbox) ===
+    def enqueue_run(self, run_id: int, chat_ids: List[str], gender: str = None,
+                    age_min: int = None, age_max: int = None) -> int:
+        """Поставить в очередь всех получателей прогона одним INSERT ... SELECT.
+
+        Пользователь из нескольких целевых чатов попадает в очередь один раз.
+        Повторный вызов (продолжение прогона) никого не добавляет дважды.
+        Возвращает число добавленных получателей.
+        """
+        if not chat_ids:
+            return 0
+
+        placeholders = ", ".join("?" for _ in chat_ids)
+        query = f"""
+            INSERT OR IGNORE INTO outbox (run_id, user_id)
+            SELECT DISTINCT ?, user_id FROM users WHERE chat_id IN ({placeholders})
+        """
+        params = [run_id, *chat_ids]
+
+        if gender and gender != "all":
+            query += " AND gender = ?"
+            params.append(gender)
+
+        if age_min is not None:
+            query += " AND age >= ?"
+            params.append(age_min)
+
+        if age_max is not None:
+            query += " AND age <= ?"
+            params.append(age_max)
+
+        with self.connection() as conn:
+            return conn.execute(query, params).rowcount
+
+    def claim_outbox(self, run_id: int, worker_id: str, limit: int,
+                     lease_seconds: float) -> array:
+        """Взять в отправку до limit получателей прогона одним UPDATE ... RETURNING.
+
+        Берутся те, чья аренда истекла (отправитель упал), и ожидающие. Прогон на
+        паузе не выдается. Возвращает array('q') с user_id.
+        """
+        now = time.time()
+        with self.connection() as conn:
+            # Две ветки - два диапазона idx_outbox_claim: через OR индекс сужался бы только
+            # по run_id, и каждая выдача проходила бы все failed и leased строки прогона
+            rows = conn.execute("""
+                UPDATE outbox
+                SET status = 'leased', worker_id = ?, lease_until = ?, attempts = attempts + 1
+                WHERE id IN (
+                    SELECT id FROM (
+                        SELECT id FROM outbox
+                        WHERE run_id = ? AND status = 'leased' AND lease_until < ?
+                        LIMIT ?
+                    )
+                    UNION ALL
+                    SELECT id FROM (
+                        SELECT id FROM outbox WHERE run_id = ? AND status = 'queued' LIMIT ?
+                    )
+                    LIMIT ?
+                )
+                AND EXISTS (SELECT 1 FROM broadcast_runs WHERE id = ? AND status = 'running')
+                RETURNING user_id
+            """, (worker_id, now + lease_seconds, run_id, now, limit, run_id, limit, limit,
+                  run_id)).fetchall()
+        return array("q", (row[0] for row in rows))
+
+    def renew_outbox_leases(self, worker_id: str, lease_seconds: float) -> int:
+        """Продлить аренду всех взятых отправителем сообщений (долгий flood control)"""
+        with self.connection() as conn:
+            return conn.execute("""
+                UPDATE outbox SET lease_until = ?
+                WHERE worker_id = ? AND status = 'leased'
+            """, (time.time() + lease_seconds, worker_id)).rowcount
+
+    def release_outbox_leases(self, worker_id: str = None):
+        """Вернуть в очередь взятые сообщения (все или одного отправителя), например
+        после перезапуска бота, который отправлял их сам"""
+        query = "UPDATE outbox SET status = 'queued', lease_until = NULL WHERE status = 'leased'"
+        params = []
+        if worker_id is not None:
+            query += " AND worker_id = ?"
+            params.append(worker_id)
+        with self.connection() as conn:
+            conn.execute(query, params)
+
+    def next_outbox_run(self) -> Optional[Dict]:
+        """Активный прогон, в очереди которого есть что отправлять"""
+        now = time.time()
+        with self.connection() as conn:
+            row = conn.execute("""
+                SELECT r.id, r.broadcast_id FROM broadcast_runs r
+                WHERE r.status = 'running' AND (
+                    EXISTS (SELECT 1 FROM outbox o WHERE o.run_id = r.id AND o.status = 'queued')
+                    OR EXISTS (SELECT 1 FROM outbox o
+                               WHERE o.run_id = r.id AND o.status = 'leased' AND o.lease_until < ?)
+                )
+                ORDER BY r.id LIMIT 1
+            """, (now,)).fetchone()
+        if row:
+            return {"id": row[0], "broadcast_id": row[1]}
+        return None
+
+    def get_outbox_progress(self, run_id: int) -> Dict[str, int]:
+        """Очередь прогона по статусам: queued, leased, sent, failed"""
+        with self.connection() as conn:
+            rows = conn.execute(
+                "SELECT status, COUNT(*) FROM outbox WHERE run_id = ? GROUP BY status",
+                (run_id,)
+            ).fetchall()
+        progress = {"queued": 0, "leased": 0, "sent": 0, "failed": 0}
+        progress.update(rows)
+        return progress
+
+    def heartbeat_worker(self, worker_id: str, paused_until: float,
+                         stale_after: float, reserved_rate: float = 0) -> tuple:
+        """Отметить процесс-отправитель живым.
+
+        paused_until - до какого времени (unix) процесс остановлен flood control,
+        reserved_rate - фиксированная доля лимита процесса (0 - делит остаток с другими).
+        Возвращает (число живых процессов без фиксированной доли, сумма фиксированных
+        долей живых процессов, максимальный paused_until среди всех живых).
+        """
+        now = time.time()
+        with self.connection() as conn:
+            conn.execute("""
+                INSERT INTO sender_workers (worker_id, heartbeat_at, paused_until, reserved_rate)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(worker_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at,
+                                                     paused_until = excluded.paused_until,
+                                                     reserved_rate = excluded.reserved_rate
+            """, (worker_id, now, paused_until, reserved_rate))
+            row = conn.execute("""
+                SELECT SUM(reserved_rate = 0),
+                       COALESCE(SUM(reserved_rate), 0), MAX(paused_until)
+                FROM sender_workers WHERE heartbeat_at >= ?
+            """, (now - stale_after,)).fetchone()
+        return row[0], row[1], row[2]
+
+    def remove_worker(self, worker_id: str):
+        with self.connection() as conn:
+            conn.execute("DELETE FROM sender_workers WHERE worker_id = ?", (worker_id,))
 
     # === ПОЛЬЗОВАТЕЛИ ===
     def add_or_update_user(self, user_id: int, chat_id: str, username: str = None,
                           first_name: str = None, gender: str = None, age: int = None):
         """Добавить или обновить пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
         try:
-            cursor.execute("""
-                INSERT INTO users (user_id, chat_id, username, first_name, gender, age)
-                VALUES (?, ?, ?, ?, ?, ?)
-                ON CONFLICT(user_id, chat_id) DO UPDATE SET
-                    username = COALESCE(?, username),
-                    first_name = COALESCE(?, first_name),
-                    gender = COALESCE(?, gender),
-                    age = COALESCE(?, age)
-            """, (user_id, chat_id, username, first_name, gender, age,
-                  username, first_name, gender, age))
-            conn.commit()
+            with self.connection() as conn:
+                conn.execute("""
+                    INSERT INTO users (user_id, chat_id, username, first_name, gender, age)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id, chat_id) DO UPDATE SET
+                        username = COALESCE(?, username),
+                        first_name = COALESCE(?, first_name),
+                        gender = COALESCE(?, gender),
+                        age = COALESCE(?, age)
+                """, (user_id, chat_id, username, first_name, gender, age,
+                      username, first_name, gender, age))
             return True
         except Exception as e:
             print(f"Error adding/updating user: {e}")
             return False
-        finally:
-            conn.close()
+
+    def add_users_bulk(self, rows: Iterable[tuple], batch_size: int = 50000) -> int:
+        """Массовая загрузка пользователей: upsert через executemany, транзакция на batch_size строк.
+
+        rows: (user_id, chat_id, username, first_name, gender, age); None не затирает
+        уже известные значения, как и в add_or_update_user. Возвращает число строк.
+        """
+        rows = iter(rows)
+        total = 0
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                return total
+            with self.connection() as conn:
+                conn.executemany("""
+                    INSERT INTO users (user_id, chat_id, username, first_name, gender, age)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(user_id, chat_id) DO UPDATE SET
+                        username = COALESCE(excluded.username, username),
+                        first_name = COALESCE(excluded.first_name, first_name),
+                        gender = COALESCE(excluded.gender, gender),
+                        age = COALESCE(excluded.age, age)
+                """, batch)
+            total += len(batch)
 
     def get_user(self, user_id: int, chat_id: str) -> Optional[Dict]:
         """Получить информацию о пользователе"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT user_id, chat_id, username, first_name, gender, age, registered_at
-            FROM users WHERE user_id = ? AND chat_id = ?
-        """, (user_id, chat_id))
-        row = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            row = conn.execute("""
+                SELECT user_id, chat_id, username, first_name, gender, age, registered_at
+                FROM users WHERE user_id = ? AND chat_id = ?
+            """, (user_id, chat_id)).fetchone()
 
         if row:
             return {
@@ -435,9 +948,6 @@ class Database:
     def get_users_in_chat(self, chat_id: str, gender: str = None,
                          age_min: int = None, age_max: int = None) -> List[Dict]:
         """Получить пользователей чата с фильтрацией"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-
         query = "SELECT user_id, username, first_name, gender, age FROM users WHERE chat_id = ?"
         params = [chat_id]
 
@@ -453,55 +963,132 @@ class Database:
             query += " AND age <= ?"
             params.append(age_max)
 
-        cursor.execute(query, params)
-        users = [{"user_id": row[0], "username": row[1], "first_name": row[2],
+        with self.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+        return [{"user_id": row[0], "username": row[1], "first_name": row[2],
                  "gender": row[3], "age": row[4]}
-                for row in cursor.fetchall()]
-        conn.close()
-        return users
+                for row in rows]
 
     def get_user_count(self, chat_id: str = None) -> int:
         """Получить количество зарегистрированных пользователей"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.connection() as conn:
+            if chat_id:
+                row = conn.execute("SELECT COUNT(*) FROM users WHERE chat_id = ?", (chat_id,)).fetchone()
+            else:
+                row = conn.execute("SELECT COUNT(*) FROM users").fetchone()
+        return row[0]
+
+    @staticmethod
+    def _user_stats(total, male, female, age_sum, age_count) -> Dict:
+        total, male, female = total or 0, male or 0, female or 0
+        return {
+            "total": total,
+            "male": male,
+            "female": female,
+            "unknown": total - male - female,
+            "avg_age": round(age_sum / age_count, 1) if age_count else None
+        }
 
+    def get_user_stats(self, chat_id: str = None) -> Dict:
+        """Получить статистику по пользователям (один проход по таблице/индексу)"""
+        query = """
+            SELECT COUNT(*), SUM(gender = 'male'), SUM(gender = 'female'),
+                   SUM(age), COUNT(age)
+            FROM users
+        """
+        params = []
         if chat_id:
-            cursor.execute("SELECT COUNT(*) FROM users WHERE chat_id = ?", (chat_id,))
-        else:
-            cursor.execute("SELECT COUNT(*) FROM users")
+            query += " WHERE chat_id = ?"
+            params.append(chat_id)
 
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count
+        with self.connection() as conn:
+            row = conn.execute(query, params).fetchone()
+        return self._user_stats(*row)
 
-    def get_user_stats(self, chat_id: str = None) -> Dict:
-        """Получить статистику по пользователям"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def get_user_stats_by_chat(self) -> Dict:
+        """Статистика пользователей сразу по всем чатам и в целом одним запросом.
 
-        base_query = "FROM users" + (" WHERE chat_id = ?" if chat_id else "")
-        params = [chat_id] if chat_id else []
-        # Определяем нужно ли использовать WHERE или AND
-        where_and = " AND" if chat_id else " WHERE"
+        Возвращает {"total": {...}, "chats": {chat_id: {...}}} в формате get_user_stats.
+        """
+        with self.connection() as conn:
+            rows = conn.execute("""
+                SELECT chat_id, COUNT(*), SUM(gender = 'male'), SUM(gender = 'female'),
+                       SUM(age), COUNT(age)
+                FROM users
+                GROUP BY chat_id
+            """).fetchall()
 
-        cursor.execute(f"SELECT COUNT(*) {base_query}", params)
-        total = cursor.fetchone()[0]
+        chats = {}
+        totals = [0, 0, 0, 0, 0]
+        for chat_id, *values in rows:
+            chats[chat_id] = self._user_stats(*values)
+            totals = [acc + (value or 0) for acc, value in zip(totals, values)]
+        return {"total": self._user_stats(*totals), "chats": chats}
 
-        cursor.execute(f"SELECT COUNT(*) {base_query}{where_and} gender = 'male'", params)
-        male = cursor.fetchone()[0]
 
-        cursor.execute(f"SELECT COUNT(*) {base_query}{where_and} gender = 'female'", params)
-        female = cursor.fetchone()[0]
+class AsyncDatabase:
+    """Асинхронная обертка над Database для вызова из обработчиков бота.
 
-        cursor.execute(f"SELECT AVG(age) {base_query}{where_and} age IS NOT NULL", params)
-        avg_age = cursor.fetchone()[0]
+    Методы те же, что у Database, но возвращают корутины: запросы выполняются
+    в отдельном пуле потоков и не блокируют event loop.
 
-        conn.close()
+        stats = await db.aio.get_user_stats(chat_id)
+    """
 
-        return {
-            "total": total,
-            "male": male,
-            "female": female,
-            "unknown": total - male - female,
-            "avg_age": round(avg_age, 1) if avg_age else None
-        }
+    def __init__(self, db: Database):
+        self._db = db
+        self._executor = ThreadPoolExecutor(max_workers=db.pool_size, thread_name_prefix="db")
+
+    def __getattr__(self, name):
+        method = getattr(self._db, name)
+        if not callable(method):
+            return method
+
+        latency = metrics.DB_LATENCY.labels(name)
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            started = time.perf_counter()
+            try:
+                return await loop.run_in_executor(self._executor, partial(method, *args, **kwargs))
+            finally:
+                latency.observe(time.perf_counter() - started)
+
+        call.__name__ = name
+        # Кэшируем обертку, чтобы не создавать ее на каждый вызов
+        setattr(self, name, call)
+        return call
+
+    async def iter_outbox(self, run_id: int, worker_id: str, batch_size: int = 100,
+                          lease_seconds: float = 300, poll_interval: float = 2.0,
+                          wait_paused: bool = True) -> AsyncIterator[int]:
+        """Получатели прогона из outbox: пачками через claim_outbox, пока очередь не пуста.
+
+        Пока генератор жив, аренда взятых сообщений продлевается. Если прогон на
+        паузе, генератор ждет продолжения (wait_paused) или завершается.
+        """
+        async def keep_leases():
+            while True:
+                await asyncio.sleep(lease_seconds / 3)
+                try:
+                    await self.renew_outbox_leases(worker_id, lease_seconds)
+                except Exception:
+                    pass  # повторим в следующий раз; аренда рассчитана с запасом
+
+        keeper = asyncio.ensure_future(keep_leases())
+        try:
+            while True:
+                batch = await self.claim_outbox(run_id, worker_id, batch_size, lease_seconds)
+                if not batch:
+                    run = await self.get_run_status(run_id)
+                    if run == "paused" and wait_paused:
+                        await asyncio.sleep(poll_interval)
+                        continue
+                    return
+                for user_id in batch:
+                    yield user_id
+        finally:
+            keeper.cancel()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
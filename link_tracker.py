@@ -0,0 +1,136 @@
+import asyncio
+import html
+import logging
+import re
+import secrets
+from collections import Counter
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+from aiohttp import web
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+# Ссылки в тексте рассылки: и в href="...", и просто в тексте
+URL_RE = re.compile(r"https?://[^\s\"'<>]+")
+# Знаки препинания после ссылки в конце предложения - не часть адреса
+TRAILING_PUNCTUATION = ".,;:!?)"
+
+
+def _split_url(match: re.Match):
+    """Ссылка из HTML-текста -> (ссылка как в тексте, хвост из знаков препинания)"""
+    text, start, end = match.string, match.start(), match.end()
+    url = match.group(0)
+    # Значение атрибута в кавычках (href="...") - адрес целиком
+    if start and text[start - 1] in "\"'" and text[end:end + 1] == text[start - 1]:
+        return url, ""
+    while url and url[-1] in TRAILING_PUNCTUATION:
+        # Закрывающая скобка с парой - часть адреса: .../Python_(programming_language)
+        if url[-1] == ")" and url.count(")") <= url.count("("):
+            break
+        url = url[:-1]
+    return url, match.group(0)[len(url):]
+
+
+class LinkTracker:
+    """Короткие ссылки для подсчета кликов.
+
+    При создании рассылки ссылки в тексте заменяются на короткие коды.
+    HTTP-сервер отвечает 302 по карте код -> URL в памяти, а клики
+    копятся в счетчиках и пишутся в link_tracking пачками раз в flush_interval.
+    """
+
+    def __init__(self, db: Database, base_url: str, host: str = "0.0.0.0",
+                 port: int = 8080, flush_interval: float = 10.0):
+        self.db = db
+        self.base_url = base_url.rstrip("/")
+        self.host = host
+        self.port = port
+        self.flush_interval = flush_interval
+        self._links: Dict[str, str] = {}
+        self._clicks = Counter()
+        self._runner: Optional[web.AppRunner] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def rewrite(self, broadcast_id: int, text: str) -> str:
+        """Заменить ссылки в тексте на короткие и сохранить их для рассылки"""
+        # Ключ - ссылка как в тексте (в HTML & экранирован как &amp;)
+        links = {}
+        for match in URL_RE.finditer(text):
+            url, _ = _split_url(match)
+            if url in links or url.startswith(self.base_url):
+                continue
+            code = secrets.token_urlsafe(6)
+            while code in self._links:
+                code = secrets.token_urlsafe(6)
+            links[url] = code
+
+        if not links:
+            return text
+
+        # В БД и в Location - настоящий адрес, без HTML-экранирования
+        await self.db.aio.add_tracked_links(
+            broadcast_id, [(html.unescape(url), code) for url, code in links.items()]
+        )
+        for url, code in links.items():
+            self._links[code] = html.unescape(url)
+
+        def replace(match):
+            url, tail = _split_url(match)
+            if url not in links:
+                return match.group(0)
+            return f"{self.base_url}/{links[url]}{tail}"
+
+        return URL_RE.sub(replace, text)
+
+    async def handle_redirect(self, request: web.Request) -> web.Response:
+        code = request.match_info["code"]
+        url = self._links.get(code)
+        if url is None:
+            return web.Response(status=404)
+        self._clicks[code] += 1
+        return web.Response(status=302, headers={"Location": url})
+
+    async def flush(self):
+        """Записать накопленные клики в БД одной транзакцией"""
+        if not self._clicks:
+            return
+        clicks, self._clicks = self._clicks, Counter()
+        try:
+            await self.db.aio.add_link_clicks(dict(clicks))
+        except Exception as e:
+            # Вернем клики обратно, запишем при следующем сбросе
+            self._clicks.update(clicks)
+            logger.error(f"Failed to flush link clicks: {e}")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def start(self):
+        """Загрузить короткие ссылки и запустить HTTP-сервер редиректов"""
+        # Ссылки, сохраненные раньше с HTML-экранированием (&amp;), тоже ведут по настоящему адресу
+        self._links = {code: html.unescape(url)
+                       for code, url in (await self.db.aio.get_tracked_links()).items()}
+
+        prefix = urlparse(self.base_url).path.rstrip("/")
+        app = web.Application()
+        app.router.add_get(f"{prefix}/{{code}}", self.handle_redirect)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        logger.info(f"Link tracker listening on {self.host}:{self.port}, {len(self._links)} links")
+
+    async def stop(self):
+        if self._flush_task:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,98 @@
+"""Обработка вступлений в чат без задержки цикла обновлений.
+
+При массовом вступлении (рейд, ссылка-приглашение) обработчик new_chat_member
+только ставит пользователя в очередь: запись в БД идет пачками одной
+транзакцией, а приветствия отправляет движок доставки с общими лимитами Telegram.
+"""
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from database import Database
+from sender import BatchWriter, BroadcastSender
+
+logger = logging.getLogger(__name__)
+
+WELCOME_TEXT = (
+    "👋 Привет, {first_name}!\n\n"
+    "Вы присоединились к чату, который использует нашего бота для рассылок.\n\n"
+    "Чтобы получать персонализированные рассылки, "
+    "пройдите быструю регистрацию:\n"
+    "/register"
+)
+
+
+class UserBatcher(BatchWriter):
+    """Новые участники чатов: upsert пачкой через Database.add_users_bulk"""
+
+    def __init__(self, db: Database, batch_size: int = 200, flush_interval: float = 0.5):
+        super().__init__(batch_size, flush_interval)
+        self.db = db
+
+    def add(self, user_id: int, chat_id: str, username: Optional[str], first_name: Optional[str]):
+        self.put((user_id, chat_id, username, first_name, None, None))
+
+    async def _write(self, rows: List[tuple]):
+        await self.db.aio.add_users_bulk(rows, batch_size=len(rows))
+
+
+class WelcomeQueue:
+    """Приветствия новым участникам через BroadcastSender.
+
+    Отправка идет с тем же токен-бакетом, что и рассылки, поэтому волна
+    вступлений не выходит за лимит Telegram (при SENDER_PROCESSES > 0 бот берет
+    себе WELCOME_RATE_LIMIT из общего лимита, см. share_rate_limit). Пользователь,
+    вступивший в несколько чатов до отправки, получает одно приветствие.
+    """
+
+    def __init__(self, bot, sender: BroadcastSender):
+        self.bot = bot
+        self.sender = sender
+        # user_id -> имя для текста приветствия, пока сообщение не отправлено
+        self._pending: Dict[int, str] = {}
+        self._queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def add(self, user_id: int, first_name: str):
+        if user_id in self._pending:
+            return
+        self._pending[user_id] = first_name
+        self._queue.put_nowait(user_id)
+
+    async def _run(self):
+        while True:
+            user_id = await self._queue.get()
+            # Одна волна вступлений - один вызов deliver с отчетом
+            try:
+                report = await self.sender.deliver(self._drain(user_id), self._send, self)
+                logger.info(f"Welcome messages: {report.summary()}")
+            except Exception as e:
+                logger.error(f"Failed to send welcome messages: {e}")
+
+    async def _drain(self, user_id: int):
+        while True:
+            yield user_id
+            try:
+                user_id = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+    async def _send(self, user_id: int):
+        first_name = self._pending.get(user_id) or ""
+        return await self.bot.send_message(
+            chat_id=user_id,
+            text=WELCOME_TEXT.format(first_name=first_name)
+        )
+
+    def record(self, user_id: int, result, error: Optional[Exception], latency: float):
+        """Итог отправки от BroadcastSender.deliver (как у DeliveryLog)"""
+        # Ошибки (например, пользователь не запускал бота) уже залогированы отправителем
+        self._pending.pop(user_id, None)
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
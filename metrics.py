@@ -0,0 +1,117 @@
+"""Метрики Prometheus для доставки рассылок и БД.
+
+Включаются настройкой METRICS_PORT при установленном prometheus_client;
+иначе все метрики - заглушки без накладных расходов, и бот работает как раньше.
+
+    pip install prometheus_client
+    METRICS_PORT=9100 python bot.py   # http://localhost:9100/metrics
+"""
+import asyncio
+import logging
+from typing import Optional
+
+import config
+
+logger = logging.getLogger(__name__)
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+ENABLED = prometheus_client is not None and config.METRICS_PORT > 0
+
+# Отправка в Telegram: от десятков миллисекунд до ожидания flood control
+SEND_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+
+class _NoopMetric:
+    """Заглушка с интерфейсом Counter/Histogram/Gauge"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount: float = 1):
+        pass
+
+    def set(self, value: float):
+        pass
+
+    def observe(self, value: float):
+        pass
+
+
+def _metric(kind: str, name: str, documentation: str, labelnames=(), **kwargs):
+    if not ENABLED:
+        return _NoopMetric()
+    return getattr(prometheus_client, kind)(name, documentation, labelnames, **kwargs)
+
+
+SEND_LATENCY = _metric(
+    "Histogram", "broadcast_send_seconds",
+    "Время одного запроса отправки к Bot API", buckets=SEND_BUCKETS
+)
+SEND_ATTEMPTS = _metric(
+    "Counter", "broadcast_send_attempts_total",
+    "Попытки отправки по результату: ok или класс ошибки Telegram", ["outcome"]
+)
+RECIPIENTS = _metric(
+    "Counter", "broadcast_recipients_total",
+    "Получатели с итогом доставки (rate() - получателей в секунду)", ["status"]
+)
+RUN_DURATION = _metric(
+    "Histogram", "broadcast_run_duration_seconds",
+    "Длительность прогона рассылки",
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+)
+RUN_THROUGHPUT = _metric(
+    "Gauge", "broadcast_run_recipients_per_second",
+    "Скорость последнего завершенного прогона"
+)
+DB_LATENCY = _metric(
+    "Histogram", "db_call_seconds",
+    "Время вызова Database через db.aio (с ожиданием потока)", ["method"], buckets=DB_BUCKETS
+)
+LOOP_LAG = _metric(
+    "Histogram", "event_loop_lag_seconds",
+    "Насколько позже срабатывает таймер цикла событий", buckets=LAG_BUCKETS
+)
+JOB_LAG = _metric(
+    "Histogram", "scheduler_job_lag_seconds",
+    "Задержка запуска задачи планировщика относительно времени по расписанию",
+    buckets=LAG_BUCKETS + (10, 30, 60, 300)
+)
+JOBS_MISSED = _metric(
+    "Counter", "scheduler_jobs_missed_total",
+    "Запуски, пропущенные из-за misfire_grace_time"
+)
+
+
+def start_server(port_offset: int = 0) -> bool:
+    """Запустить HTTP-эндпоинт /metrics (в отдельном потоке)"""
+    if config.METRICS_PORT <= 0:
+        return False
+    if prometheus_client is None:
+        logger.warning("METRICS_PORT задан, но prometheus_client не установлен - метрики выключены")
+        return False
+    port = config.METRICS_PORT + port_offset
+    prometheus_client.start_http_server(port, addr=config.METRICS_HOST)
+    logger.info(f"Metrics listening on {config.METRICS_HOST}:{port}")
+    return True
+
+
+async def _watch_loop_lag(interval: float):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - started - interval))
+
+
+def start_loop_monitor(interval: float = 0.5) -> Optional[asyncio.Task]:
+    """Фоновая задача замера задержки цикла событий (только при включенных метриках)"""
+    if not ENABLED:
+        return None
+    return asyncio.create_task(_watch_loop_lag(interval))
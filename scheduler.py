@@ -1,10 +1,18 @@
+from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.date import DateTrigger
 from apscheduler.triggers.interval import IntervalTrigger
 from datetime import datetime, timedelta
 from database import Database
+from sender import BroadcastSender, DeliveryLog, MessageTemplate, share_rate_limit
+import config
+import metrics
 import pytz
+import asyncio
 import logging
+import os
+import socket
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -14,23 +22,72 @@ MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 
 class BroadcastScheduler:
     def __init__(self, bot, db: Database):
-        self.scheduler = AsyncIOScheduler(timezone=MOSCOW_TZ)
+        self.scheduler = AsyncIOScheduler(
+            timezone=MOSCOW_TZ,
+            job_defaults={
+                # Сколько секунд после пропущенного времени запуск еще допустим
+                "misfire_grace_time": config.JOB_MISFIRE_GRACE_TIME,
+                # Несколько пропущенных запусков выполняются одним
+                "coalesce": config.JOB_COALESCE
+            }
+        )
         self.bot = bot
         self.db = db
+        self._running = set()
+        # Отправитель в outbox, если рассылки отправляет сам бот
+        self.worker_id = f"bot:{socket.gethostname()}:{os.getpid()}"
+        # Общий для всех рассылок движок доставки (единый глобальный лимит)
+        self.sender = BroadcastSender(
+            workers=config.SEND_WORKERS,
+            rate=config.SEND_RATE_LIMIT,
+            per_chat_interval=config.SEND_PER_CHAT_INTERVAL,
+            max_retries=config.SEND_MAX_RETRIES,
+            backoff_base=config.SEND_BACKOFF_BASE,
+            backoff_max=config.SEND_BACKOFF_MAX
+        )
+        self._rate_sharing = None
 
     def start(self):
         """Запуск планировщика"""
+        self.scheduler.add_listener(self._on_job_event, EVENT_JOB_SUBMITTED | EVENT_JOB_MISSED)
         self.scheduler.start()
         logger.info("Scheduler started")
 
-    def schedule_broadcast(self, broadcast_id: int):
-        """Планирование рассылки"""
-        broadcast = self.db.get_broadcast(broadcast_id)
+    def start_rate_sharing(self):
+        """При SENDER_PROCESSES > 0 бот сам шлет только приветствия: берет себе
+        WELCOME_RATE_LIMIT из общего лимита Telegram и делит с процессами
+        worker.py паузы flood control"""
+        if config.SENDER_PROCESSES > 0 and self._rate_sharing is None:
+            self._rate_sharing = asyncio.create_task(share_rate_limit(
+                self.db, self.sender.bucket, self.worker_id,
+                config.SEND_RATE_LIMIT, config.SENDER_HEARTBEAT_INTERVAL,
+                reserved=config.WELCOME_RATE_LIMIT
+            ))
+
+    async def stop_rate_sharing(self):
+        if self._rate_sharing:
+            self._rate_sharing.cancel()
+            await asyncio.gather(self._rate_sharing, return_exceptions=True)
+            self._rate_sharing = None
+
+    @staticmethod
+    def _on_job_event(event):
+        """Метрики планировщика: опоздание запуска и пропущенные запуски"""
+        if event.code == EVENT_JOB_MISSED:
+            metrics.JOBS_MISSED.inc()
+            return
+        lag = datetime.now(MOSCOW_TZ) - event.scheduled_run_times[-1]
+        metrics.JOB_LAG.observe(max(0.0, lag.total_seconds()))
+
+    def schedule_broadcast(self, broadcast_id: int, broadcast: dict = None):
+        """Планирование рассылки (broadcast - уже загруженная строка из БД, если есть)"""
+        if broadcast is None:
+            broadcast = self.db.get_broadcast(broadcast_id)
         if not broadcast:
             logger.error(f"Broadcast {broadcast_id} not found")
             return
 
-        scheduled_time = datetime.fromisoformat(broadcast["scheduled_time"])
+        scheduled_time = self._parse_time(broadcast["scheduled_time"])
         frequency = broadcast["frequency"]
 
         if frequency == "once":
@@ -63,100 +120,183 @@ class BroadcastScheduler:
             )
             logger.info(f"Scheduled {frequency} broadcast {broadcast_id} starting at {scheduled_time}")
 
+    @staticmethod
+    def _parse_time(value: str) -> datetime:
+        scheduled_time = datetime.fromisoformat(value)
+        if scheduled_time.tzinfo is None:
+            scheduled_time = MOSCOW_TZ.localize(scheduled_time)
+        return scheduled_time
+
+    def restore_broadcasts(self):
+        """Восстановление рассылок из БД после перезапуска.
+
+        Читает только список pending/active рассылок (без запроса на каждую).
+        Одноразовая рассылка, пропущенная дольше JOB_MISFIRE_GRACE_TIME,
+        помечается как failed; в пределах окна - отправляется сразу.
+        Периодические продолжают со следующего запуска по расписанию.
+        Прогоны, прерванные перезапуском, продолжаются сразу с чекпоинта.
+        """
+        now = datetime.now(MOSCOW_TZ)
+        grace = config.JOB_MISFIRE_GRACE_TIME
+        open_runs = set(self.db.get_open_run_broadcasts())
+        if config.SENDER_PROCESSES <= 0:
+            # Отправлял только этот процесс: взятое до перезапуска возвращаем в очередь
+            self.db.release_outbox_leases()
+        restored = 0
+        missed = 0
+
+        for status in ("pending", "active"):
+            for broadcast in self.db.get_broadcasts(status):
+                broadcast_id = broadcast["id"]
+                if broadcast["current_repeat"] >= broadcast["repeat_count"]:
+                    self.db.update_broadcast_status(broadcast_id, "completed")
+                    continue
+
+                if broadcast_id in open_runs:
+                    self.scheduler.add_job(
+                        self.send_broadcast,
+                        args=[broadcast_id],
+                        id=f"resume_{broadcast_id}",
+                        replace_existing=True
+                    )
+                    logger.info(f"Resuming interrupted broadcast {broadcast_id}")
+                    if broadcast["frequency"] == "once":
+                        restored += 1
+                        continue
+
+                scheduled_time = self._parse_time(broadcast["scheduled_time"])
+                if (broadcast["frequency"] == "once" and grace is not None
+                        and (now - scheduled_time).total_seconds() > grace):
+                    self.db.update_broadcast_status(broadcast_id, "failed")
+                    logger.warning(f"Broadcast {broadcast_id} missed its run at {scheduled_time}")
+                    missed += 1
+                    continue
+
+                self.schedule_broadcast(broadcast_id, broadcast)
+                restored += 1
+
+        logger.info(f"Restored {restored} broadcasts, {missed} missed")
+
     async def send_broadcast(self, broadcast_id: int):
         """Отправка рассылки"""
+        # Один прогон рассылки за раз (например, продолжение и очередной запуск)
+        if broadcast_id in self._running:
+            logger.warning(f"Broadcast {broadcast_id} is already being sent, skipping")
+            return
+        self._running.add(broadcast_id)
         try:
-            broadcast = self.db.get_broadcast(broadcast_id)
+            await self._send_broadcast(broadcast_id)
+        finally:
+            self._running.discard(broadcast_id)
+
+    async def _send_broadcast(self, broadcast_id: int):
+        run_id = None
+        try:
+            broadcast = await self.db.aio.get_broadcast(broadcast_id)
             if not broadcast:
                 logger.error(f"Broadcast {broadcast_id} not found")
                 return
 
             # Проверка на количество повторов
             if broadcast["current_repeat"] >= broadcast["repeat_count"]:
-                self.db.update_broadcast_status(broadcast_id, "completed")
+                await self.db.aio.update_broadcast_status(broadcast_id, "completed")
                 self.cancel_broadcast(broadcast_id)
                 logger.info(f"Broadcast {broadcast_id} completed all repeats")
                 return
 
-            # Параметры рассылки
-            message_text = broadcast["message_text"]
             target_chats = broadcast["target_chats"]
-            gender_filter = broadcast.get("gender_filter")
-            age_min = broadcast.get("age_min")
-            age_max = broadcast.get("age_max")
-
-            success_count = 0
-            fail_count = 0
-
-            # Проверяем, нужна ли фильтрация
-            has_filters = gender_filter or age_min is not None or age_max is not None
-
-            for chat_id in target_chats:
-                if has_filters:
-                    # С фильтрами - отправляем личные сообщения пользователям
-                    users = self.db.get_users_in_chat(
-                        chat_id,
-                        gender=gender_filter,
-                        age_min=age_min,
-                        age_max=age_max
-                    )
 
-                    if not users:
-                        logger.warning(f"No users matching filters in chat {chat_id}")
-                        continue
-
-                    for user in users:
-                        try:
-                            await self.bot.send_message(
-                                chat_id=user["user_id"],
-                                text=message_text,
-                                parse_mode="HTML"
-                            )
-                            success_count += 1
-                            logger.info(f"Sent broadcast {broadcast_id} to user {user['user_id']} in chat {chat_id}")
-                        except Exception as e:
-                            fail_count += 1
-                            logger.error(f"Failed to send to user {user['user_id']}: {e}")
-
-                    self.db.add_broadcast_stat(broadcast_id, chat_id)
-                else:
-                    # Без фильтров - отправляем всем участникам чата в личные сообщения
-                    users = self.db.get_users_in_chat(chat_id)
-
-                    if not users:
-                        logger.warning(f"No registered users in chat {chat_id}")
-                        continue
+            # Прерванный прогон продолжаем по его очереди outbox, а не с начала аудитории
+            run = await self.db.aio.get_open_run(broadcast_id)
+            if run:
+                run_id = run["id"]
+                logger.info(f"Resuming broadcast {broadcast_id} run {run_id}")
+            else:
+                run_id = await self.db.aio.create_run(broadcast_id, broadcast["current_repeat"] + 1)
 
-                    for user in users:
-                        try:
-                            await self.bot.send_message(
-                                chat_id=user["user_id"],
-                                text=message_text,
-                                parse_mode="HTML"
-                            )
-                            success_count += 1
-                            logger.info(f"Sent broadcast {broadcast_id} to user {user['user_id']} in chat {chat_id}")
-                        except Exception as e:
-                            fail_count += 1
-                            logger.error(f"Failed to send to user {user['user_id']}: {e}")
+            # Пользователь из нескольких целевых чатов попадет в очередь один раз
+            queued = await self.db.aio.enqueue_run(
+                run_id,
+                target_chats,
+                gender=broadcast.get("gender_filter"),
+                age_min=broadcast.get("age_min"),
+                age_max=broadcast.get("age_max")
+            )
+            logger.info(f"Broadcast {broadcast_id} run {run_id}: {queued} recipients queued")
 
-                    self.db.add_broadcast_stat(broadcast_id, chat_id)
+            started = time.monotonic()
+            if config.SENDER_PROCESSES > 0:
+                await self._wait_for_senders(run_id)
+                report = None
+            else:
+                report = await self._deliver_local(broadcast, run_id)
+            # Итоги прогона и +1 повтор
+            totals = await self.db.aio.finish_run(run_id)
+            duration = time.monotonic() - started
+            metrics.RUN_DURATION.observe(duration)
+            if duration > 0:
+                metrics.RUN_THROUGHPUT.set((totals["sent"] + totals["failed"]) / duration)
 
-            # Обновление статуса
-            self.db.increment_broadcast_repeat(broadcast_id)
+            if totals["sent"] + totals["failed"] == 0:
+                logger.warning(f"No users matching filters for broadcast {broadcast_id}")
 
             # Если одноразовая рассылка - завершаем
             if broadcast["frequency"] == "once":
-                self.db.update_broadcast_status(broadcast_id, "completed")
+                await self.db.aio.update_broadcast_status(broadcast_id, "completed")
                 self.cancel_broadcast(broadcast_id)
             else:
-                self.db.update_broadcast_status(broadcast_id, "active")
+                await self.db.aio.update_broadcast_status(broadcast_id, "active")
 
-            logger.info(f"Broadcast {broadcast_id} sent: {success_count} success, {fail_count} failed")
+            if report is not None:
+                summary = report.summary()
+            else:
+                summary = (f"{totals['sent']} success, {totals['failed']} failed "
+                           f"in {duration:.1f}s "
+                           f"({config.SENDER_PROCESSES} sender processes)")
+            logger.info(f"Broadcast {broadcast_id} sent: {summary}")
 
         except Exception as e:
             logger.error(f"Error sending broadcast {broadcast_id}: {e}")
-            self.db.update_broadcast_status(broadcast_id, "failed")
+            await self.db.aio.update_broadcast_status(broadcast_id, "failed")
+            # Иначе worker.py продолжит отправлять прогон, который никто не завершит
+            if run_id is not None:
+                try:
+                    await self.db.aio.fail_run(run_id)
+                except Exception as e:
+                    logger.error(f"Failed to close run {run_id} of broadcast {broadcast_id}: {e}")
+
+    async def _deliver_local(self, broadcast: dict, run_id: int):
+        """Отправить прогон в этом процессе, выбирая получателей из outbox"""
+        # Запрос кодируется один раз на прогон, для каждого получателя меняется только chat_id
+        send = MessageTemplate.for_broadcast(self.bot, broadcast).send
+        recipients = self.db.aio.iter_outbox(
+            run_id,
+            self.worker_id,
+            batch_size=config.OUTBOX_BATCH_SIZE,
+            lease_seconds=config.SENDER_LEASE_TIMEOUT,
+            poll_interval=config.SENDER_HEARTBEAT_INTERVAL
+        )
+        delivery_log = DeliveryLog(
+            self.db, broadcast["id"], run_id,
+            batch_size=config.DELIVERY_LOG_BATCH_SIZE,
+            flush_interval=config.DELIVERY_LOG_FLUSH_INTERVAL
+        )
+        delivery_log.start()
+        try:
+            return await self.sender.deliver(recipients, send, delivery_log)
+        finally:
+            await delivery_log.close()
+
+    async def _wait_for_senders(self, run_id: int):
+        """Дождаться, пока процессы-отправители (worker.py) разберут очередь прогона.
+
+        Бот только опрашивает БД, поэтому админ-интерфейс не тормозит во время рассылки.
+        """
+        while True:
+            progress = await self.db.aio.get_outbox_progress(run_id)
+            if not progress["queued"] and not progress["leased"]:
+                return
+            await asyncio.sleep(config.SENDER_HEARTBEAT_INTERVAL)
 
     def cancel_broadcast(self, broadcast_id: int):
         """Отмена запланированной рассылки"""
@@ -0,0 +1,543 @@
+import asyncio
+import json
+import logging
+import random
+import re
+import time
+from abc import ABC, abstractmethod
+from array import array
+from datetime import datetime, timedelta
+from typing import AsyncIterable, Awaitable, Callable, Dict, Iterable, List, Optional, Union
+
+from telegram import Bot
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.request import BaseRequest, RequestData
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Токен-бакет: глобальное ограничение частоты запросов к Bot API.
+
+    При срабатывании flood control скорость снижается вдвое и затем
+    постепенно восстанавливается до исходной после успешных отправок.
+    """
+
+    def __init__(self, rate: float, capacity: float = None, min_rate: float = 1.0):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Дождаться одного токена (очередь ожидающих обслуживается по порядку)"""
+        async with self._lock:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    self._tokens = 0
+                    self._updated = time.monotonic()
+                    continue
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Остановить все отправки на seconds (RetryAfter от Telegram)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def paused_for(self) -> float:
+        """Сколько секунд еще длится пауза"""
+        return max(0.0, self._paused_until - time.monotonic())
+
+    def set_max_rate(self, rate: float):
+        """Сменить потолок скорости (доля общего лимита у одного из нескольких процессов)"""
+        if rate == self.max_rate:
+            return
+        self._refill()
+        scale = rate / self.max_rate
+        self.max_rate = rate
+        self.min_rate = min(self.min_rate, rate)
+        self.rate = min(rate, max(self.min_rate, self.rate * scale))
+        self.capacity *= scale
+        self._tokens = min(self._tokens, self.capacity)
+
+    def penalize(self):
+        """Снизить скорость после flood control"""
+        self._refill()
+        self.rate = max(self.min_rate, self.rate / 2)
+
+    def reward(self):
+        """Плавно вернуть скорость к максимальной после успешной отправки"""
+        if self.rate < self.max_rate:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+async def share_rate_limit(db, bucket: TokenBucket, worker_id: str,
+                           rate: float, interval: float, reserved: float = 0):
+    """Общий лимит Telegram для нескольких процессов (бот и worker.py).
+
+    Процесс отмечается в sender_workers. Процесс с reserved > 0 (бот с
+    приветствиями) берет себе постоянно reserved, остаток лимита rate делится
+    поровну между остальными живыми процессами. Пауза flood control любого
+    процесса останавливает все.
+    """
+    try:
+        while True:
+            try:
+                now = time.time()
+                # Процесс, пропустивший несколько отметок, считается остановленным
+                active, reserved_total, paused_until = await db.aio.heartbeat_worker(
+                    worker_id, now + bucket.paused_for(), stale_after=interval * 3,
+                    reserved_rate=reserved
+                )
+                if reserved:
+                    bucket.set_max_rate(reserved)
+                else:
+                    bucket.set_max_rate(max(1.0, rate - reserved_total) / max(1, active))
+                if paused_until and paused_until > now:
+                    bucket.pause(paused_until - now)
+            except Exception as e:
+                logger.error(f"Sender heartbeat failed: {e}")
+            await asyncio.sleep(interval)
+    finally:
+        try:
+            await db.aio.remove_worker(worker_id)
+        except Exception as e:
+            logger.error(f"Failed to unregister sender {worker_id}: {e}")
+
+
+class PerChatLimiter:
+    """Ограничение частоты сообщений в один чат (~1 сообщение в секунду)"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        # chat_id -> время последней отправки; порядок вставки совпадает с порядком времени
+        self._last_sent = {}
+
+    def _prune(self, now: float):
+        while self._last_sent:
+            chat_id = next(iter(self._last_sent))
+            if now - self._last_sent[chat_id] < self.interval:
+                break
+            del self._last_sent[chat_id]
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        self._prune(now)
+        last = self._last_sent.pop(chat_id, None)
+        # Резервируем слот сразу, чтобы параллельные воркеры встали в очередь за ним
+        slot = now if last is None else max(now, last + self.interval)
+        self._last_sent[chat_id] = slot
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class DeliveryReport:
+    """Итоги одного прогона рассылки: счетчики, пропускная способность, задержки"""
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        # Задержки в компактном массиве double: на больших прогонах это миллионы значений
+        self.latencies = array("d")
+        self.started_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+
+    def record(self, ok: bool, latency: float):
+        if ok:
+            self.sent += 1
+        else:
+            self.failed += 1
+        self.latencies.append(latency)
+
+    def finish(self):
+        self.finished_at = time.monotonic()
+
+    @property
+    def duration(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def throughput(self) -> float:
+        """Сообщений в секунду"""
+        duration = self.duration
+        return (self.sent + self.failed) / duration if duration > 0 else 0.0
+
+    def percentile(self, p: float) -> float:
+        """Перцентиль задержки отправки в секундах"""
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def summary(self) -> str:
+        return (
+            f"{self.sent} success, {self.failed} failed, {self.retries} retries "
+            f"in {self.duration:.1f}s "
+            f"({self.throughput:.1f} msg/s, "
+            f"p50={self.percentile(50) * 1000:.0f}ms, "
+            f"p95={self.percentile(95) * 1000:.0f}ms, "
+            f"p99={self.percentile(99) * 1000:.0f}ms)"
+        )
+
+
+def _seconds(value) -> float:
+    """retry_after может прийти числом или timedelta (в зависимости от версии PTB)"""
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+async def _observed(send: Callable[[int], Awaitable[object]], chat_id: int):
+    """Одна попытка отправки с метриками: время и результат (ok или класс ошибки)"""
+    started = time.monotonic()
+    try:
+        result = await send(chat_id)
+    except Exception as e:
+        metrics.SEND_LATENCY.observe(time.monotonic() - started)
+        metrics.SEND_ATTEMPTS.labels(type(e).__name__).inc()
+        raise
+    metrics.SEND_LATENCY.observe(time.monotonic() - started)
+    metrics.SEND_ATTEMPTS.labels("ok").inc()
+    return result
+
+
+# RequestData в PTB - деталь реализации (помечен @final), а не публичный API.
+# Подкласс рассчитан на python-telegram-bot==21.5 из requirements.txt; каждый
+# MessageTemplate перед первой отправкой сверяет свой запрос с тем, что собирает
+# сама PTB (MessageTemplate._check), и при расхождении отправляет через методы бота.
+class _ChatRequestData(RequestData):
+    """Готовые параметры запроса, в которые подставляется только chat_id"""
+
+    __slots__ = ("_params", "_template", "_chat_id")
+
+    def __init__(self, params: Dict[str, object], template: Dict[str, str], chat_id: int):
+        super().__init__()
+        self._params = params
+        self._template = template
+        self._chat_id = chat_id
+
+    @property
+    def parameters(self) -> Dict[str, object]:
+        return {**self._params, "chat_id": self._chat_id}
+
+    @property
+    def json_parameters(self) -> Dict[str, str]:
+        return {**self._template, "chat_id": str(self._chat_id)}
+
+
+class _CaptureRequest(BaseRequest):
+    """Запрос без сети: запоминает параметры и отвечает как sendMessage/copyMessage"""
+
+    def __init__(self):
+        self.parameters = None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        self.parameters = request_data.json_parameters if request_data else {}
+        return 200, json.dumps({"ok": True, "result": {
+            "message_id": 1,
+            "date": 0,
+            "chat": {"id": 1, "type": "private"},
+        }}).encode()
+
+
+class MessageTemplate:
+    """Запрос Bot API, сериализованный один раз на прогон рассылки.
+
+    bot.send_message на каждого получателя заново собирает и кодирует одни и те же
+    параметры и разбирает ответ в объект Message. Здесь параметры кодируются
+    один раз, а send(chat_id) отправляет их напрямую через bot.request и
+    возвращает ответ Bot API как dict. Ошибки Telegram (RetryAfter, BadRequest, ...)
+    те же, что у методов бота. Перед первой отправкой запрос сверяется с тем, что
+    собрала бы сама PTB; при расхождении отправка идет обычным методом бота.
+    """
+
+    def __init__(self, bot, method: str, **params):
+        self.bot = bot
+        self.method = method
+        self.url = f"{bot.base_url}/{method}"
+        self._params = {key: value for key, value in params.items() if value is not None}
+        # Строковые параметры Bot API передаются как есть, остальные - в JSON
+        self._template = {
+            key: value if isinstance(value, str) else json.dumps(value)
+            for key, value in self._params.items()
+        }
+        # Тот же запрос через метод бота: sendMessage -> bot.send_message
+        self._bot_method = re.sub(r"(?<!^)(?=[A-Z])", "_", method).lower()
+        self._checked: Optional[asyncio.Future] = None
+
+    @classmethod
+    def text(cls, bot, text: str, parse_mode: Optional[str] = "HTML") -> "MessageTemplate":
+        """sendMessage с готовым текстом"""
+        return cls(bot, "sendMessage", text=text, parse_mode=parse_mode)
+
+    @classmethod
+    def copy(cls, bot, from_chat_id: int, message_id: int, caption: Optional[str] = None,
+             parse_mode: Optional[str] = "HTML") -> "MessageTemplate":
+        """copyMessage: медиа уже лежит на серверах Telegram и не загружается заново.
+
+        caption - подпись вместо исходной (например, с замененными ссылками).
+        """
+        return cls(bot, "copyMessage", from_chat_id=from_chat_id, message_id=message_id,
+                   caption=caption, parse_mode=parse_mode if caption else None)
+
+    @classmethod
+    def for_broadcast(cls, bot, broadcast: Dict) -> "MessageTemplate":
+        """Запрос для рассылки: копия исходного сообщения с медиа или текст"""
+        if broadcast.get("source_message_id"):
+            # Медиа копируется из исходного сообщения без повторной загрузки
+            return cls.copy(bot, broadcast["source_chat_id"], broadcast["source_message_id"],
+                            caption=broadcast["message_text"] or None)
+        return cls.text(bot, broadcast["message_text"], parse_mode="HTML")
+
+    async def _check(self) -> bool:
+        """Совпадает ли готовый запрос с тем, что для тех же параметров собирает PTB"""
+        request = _CaptureRequest()
+        # Оба запроса - заглушки: иначе Bot создаст HTTPXRequest для getUpdates, который никто не закроет
+        bot = Bot(self.bot.token, request=request, get_updates_request=request)
+        try:
+            await getattr(bot, self._bot_method)(chat_id=1, **self._params)
+            expected = request.parameters
+            await request.post(self.url, _ChatRequestData(self._params, self._template, 1))
+            if request.parameters == expected:
+                return True
+            logger.error(f"MessageTemplate {self.method}: parameters differ from "
+                         f"python-telegram-bot ({request.parameters} != {expected})")
+        except Exception as e:
+            logger.error(f"MessageTemplate {self.method} is incompatible with "
+                         f"python-telegram-bot: {e}")
+        logger.error(f"Sending {self.method} via bot.{self._bot_method} instead")
+        return False
+
+    async def send(self, chat_id: int):
+        """Ответ Bot API как dict (или объект PTB, если готовый запрос не прошел проверку)"""
+        if self._checked is None:
+            self._checked = asyncio.ensure_future(self._check())
+        if await self._checked:
+            return await self.bot.request.post(
+                self.url, _ChatRequestData(self._params, self._template, chat_id)
+            )
+        return await getattr(self.bot, self._bot_method)(chat_id=chat_id, **self._params)
+
+
+class BroadcastSender:
+    """Движок доставки: пул воркеров + глобальный и per-chat лимиты Telegram"""
+
+    def __init__(self, workers: int = 20, rate: float = 30, per_chat_interval: float = 1.0,
+                 max_retries: int = 5, backoff_base: float = 1.0, backoff_max: float = 30.0):
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.chat_limiter = PerChatLimiter(per_chat_interval)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def _backoff(self, attempt: int) -> float:
+        """Экспоненциальная задержка с полным джиттером"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def _send_with_retry(self, chat_id: int, send: Callable[[int], Awaitable[object]],
+                               report: DeliveryReport):
+        """Отправка с повторами: RetryAfter - ждем указанное время, сетевые ошибки - backoff.
+
+        Возвращает (результат send, исключение или None, задержка последней попытки).
+        """
+        attempt = 0
+        while True:
+            await self.chat_limiter.acquire(chat_id)
+            await self.bucket.acquire()
+            started = time.monotonic()
+            try:
+                result = await _observed(send, chat_id)
+                self.bucket.reward()
+                return result, None, time.monotonic() - started
+            except RetryAfter as e:
+                # Flood control: притормаживаем весь движок, а не только этого воркера
+                delay = _seconds(e.retry_after)
+                self.bucket.pause(delay)
+                self.bucket.penalize()
+                error = e
+                logger.warning(f"Flood control: pausing sends for {delay}s, "
+                               f"rate lowered to {self.bucket.rate:.1f} msg/s")
+            except BadRequest as e:
+                # BadRequest наследуется от NetworkError, но повтор не поможет
+                logger.error(f"Failed to send to user {chat_id}: {e}")
+                return None, e, time.monotonic() - started
+            except NetworkError as e:
+                # TimedOut и прочие временные сетевые ошибки
+                delay = self._backoff(attempt)
+                logger.warning(f"Transient error sending to user {chat_id}: {e}, "
+                               f"retry in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                error = e
+            except Exception as e:
+                logger.error(f"Failed to send to user {chat_id}: {e}")
+                return None, e, time.monotonic() - started
+
+            attempt += 1
+            if attempt > self.max_retries:
+                logger.error(f"Giving up on user {chat_id} after {self.max_retries} retries")
+                return None, error, time.monotonic() - started
+            report.retries += 1
+
+    async def deliver(self, recipients: Union[Iterable[int], AsyncIterable[int]],
+                      send: Callable[[int], Awaitable[object]],
+                      delivery_log: "DeliveryLog" = None) -> DeliveryReport:
+        """Отправить сообщение всем получателям, вызывая send(chat_id) в пуле воркеров.
+
+        recipients может быть обычным или асинхронным итератором (например, очередь outbox).
+        Если передан delivery_log (DeliveryLog или другой объект с таким же record),
+        итог по каждому получателю передается в delivery_log.record.
+        """
+        report = DeliveryReport()
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+
+        async def worker():
+            while True:
+                chat_id = await queue.get()
+                try:
+                    if chat_id is None:
+                        return
+                    result, error, latency = await self._send_with_retry(chat_id, send, report)
+                    report.record(error is None, latency)
+                    metrics.RECIPIENTS.labels("sent" if error is None else "failed").inc()
+                    if error is None:
+                        logger.debug(f"Sent to user {chat_id}")
+                    if delivery_log is not None:
+                        delivery_log.record(chat_id, result, error, latency)
+                finally:
+                    queue.task_done()
+
+        tasks = [asyncio.create_task(worker()) for _ in range(self.workers)]
+        try:
+            if hasattr(recipients, "__aiter__"):
+                async for chat_id in recipients:
+                    await queue.put(chat_id)
+            else:
+                for chat_id in recipients:
+                    await queue.put(chat_id)
+            for _ in tasks:
+                await queue.put(None)
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        report.finish()
+        return report
+
+
+class BatchWriter(ABC):
+    """Фоновая запись в БД пачками: строка ставится в очередь без ожидания БД,
+    пачка пишется одной транзакцией по batch_size строк или раз в flush_interval.
+    """
+
+    def __init__(self, batch_size: int = 500, flush_interval: float = 1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def put(self, row: tuple):
+        self._queue.put_nowait(row)
+
+    @abstractmethod
+    async def _write(self, rows: List[tuple]):
+        """Записать пачку строк в БД"""
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            row = await self._queue.get()
+            rows = []
+            # Копим пачку до batch_size строк или flush_interval секунд
+            deadline = loop.time() + self.flush_interval
+            while row is not None:
+                rows.append(row)
+                timeout = deadline - loop.time()
+                if len(rows) >= self.batch_size or timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            if row is None:
+                closing = True
+            if rows:
+                try:
+                    await self._write(rows)
+                except Exception as e:
+                    logger.error(f"{type(self).__name__}: failed to write {len(rows)} rows: {e}")
+
+    async def close(self):
+        """Дописать все накопленные записи и остановить фоновую задачу"""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+
+class DeliveryLog(BatchWriter):
+    """Журнал доставки по получателям: пишется пачками из фоновой задачи,
+    чтобы запись в БД не тормозила цикл отправки.
+
+    Запись пачки в журнал заодно подтверждает (ack) эти сообщения в outbox.
+    """
+
+    def __init__(self, db, broadcast_id: int, run_id: int,
+                 batch_size: int = 500, flush_interval: float = 1.0):
+        super().__init__(batch_size, flush_interval)
+        self.db = db
+        self.broadcast_id = broadcast_id
+        self.run_id = run_id
+
+    def record(self, user_id: int, result, error: Optional[Exception], latency: float):
+        """Поставить запись в очередь (без ожидания БД)"""
+        # Ответ Bot API (dict от MessageTemplate) или объект Message
+        if isinstance(result, dict):
+            message_id = result.get("message_id")
+        else:
+            message_id = getattr(result, "message_id", None)
+        self.put((
+            self.run_id,
+            self.broadcast_id,
+            user_id,
+            "sent" if error is None else "failed",
+            type(error).__name__ if error is not None else None,
+            message_id,
+            round(latency * 1000),
+            datetime.now().isoformat()
+        ))
+
+    async def _write(self, rows: List[tuple]):
+        await self.db.aio.add_deliveries(rows, self.run_id)
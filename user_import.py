@@ -0,0 +1,134 @@
+"""Массовый импорт пользователей из CSV, JSON (массив объектов) или JSONL.
+
+Bot API не умеет выдавать список участников чата, поэтому уже существующих
+участников нужно выгрузить другим инструментом (экспорт из CRM, клиент на
+MTProto и т.п.) и загрузить файлом. Колонки / ключи:
+
+    user_id (обязательно), chat_id, username, first_name, gender (male/female), age
+
+chat_id можно не указывать в файле, если он задан для всего импорта.
+
+    python user_import.py members.csv --chat-id -1001234567890
+    python user_import.py members.jsonl
+
+В боте то же самое делает команда /import (файл до 20 МБ - ограничение Bot API).
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import time
+from typing import IO, Iterator, Optional
+
+from database import Database
+import config
+
+GENDERS = {"male": "male", "m": "male", "м": "male", "female": "female", "f": "female", "ж": "female"}
+
+
+class UserImport:
+    """Разбор файла в строки для Database.add_users_bulk; битые строки пропускаются"""
+
+    def __init__(self, chat_id: Optional[str] = None):
+        self.chat_id = chat_id
+        self.skipped = 0
+
+    @staticmethod
+    def detect_format(filename: str) -> str:
+        name = filename.lower()
+        if name.endswith(".json"):
+            return "json"
+        return "jsonl" if name.endswith((".jsonl", ".ndjson")) else "csv"
+
+    def rows(self, file: IO[str], fmt: str) -> Iterator[tuple]:
+        if fmt == "json":
+            records = self._json(file)
+        elif fmt == "jsonl":
+            records = self._jsonl(file)
+        else:
+            records = csv.DictReader(file)
+        for record in records:
+            row = self._row(record)
+            if row is None:
+                self.skipped += 1
+            else:
+                yield row
+
+    def _json(self, file: IO[str]) -> Iterator[dict]:
+        """Массив объектов целиком; .json с объектом на строку разбирается как JSONL"""
+        text = file.read()
+        if not text.lstrip().startswith("["):
+            yield from self._jsonl(io.StringIO(text))
+            return
+        try:
+            records = json.loads(text)
+        except ValueError as e:
+            raise ValueError(f"некорректный JSON: {e}") from None
+        for record in records:
+            yield record if isinstance(record, dict) else {}
+
+    def _jsonl(self, file: IO[str]) -> Iterator[dict]:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield record if isinstance(record, dict) else {}
+
+    def _row(self, record: dict) -> Optional[tuple]:
+        try:
+            user_id = int(record["user_id"])
+        except (KeyError, TypeError, ValueError):
+            return None
+        chat_id = record.get("chat_id") or self.chat_id
+        if not chat_id:
+            return None
+
+        gender = GENDERS.get(str(record.get("gender") or "").strip().lower())
+        try:
+            age = int(record["age"]) if record.get("age") not in (None, "") else None
+        except (TypeError, ValueError):
+            age = None
+        return (
+            user_id,
+            str(chat_id).strip(),
+            record.get("username") or None,
+            record.get("first_name") or None,
+            gender,
+            age
+        )
+
+    def load(self, db: Database, file: IO[str], fmt: str) -> int:
+        """Загрузить файл в БД, вернуть число загруженных строк"""
+        return db.add_users_bulk(self.rows(file, fmt), batch_size=config.IMPORT_BATCH_SIZE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Массовый импорт пользователей из CSV/JSON/JSONL")
+    parser.add_argument("path", help="файл .csv, .json или .jsonl")
+    parser.add_argument("--chat-id", help="chat_id для строк, где он не указан")
+    parser.add_argument("--format", choices=("csv", "json", "jsonl"),
+                        help="формат файла (по умолчанию - по расширению)")
+    args = parser.parse_args()
+
+    db = Database(config.DATABASE_PATH, busy_timeout=config.DB_BUSY_TIMEOUT)
+    db.init_db()
+    importer = UserImport(args.chat_id)
+    started = time.perf_counter()
+    try:
+        with open(args.path, encoding="utf-8-sig", newline="") as file:
+            loaded = importer.load(db, file, args.format or importer.detect_format(args.path))
+    except ValueError as e:
+        raise SystemExit(f"Import failed: {e}")
+    finally:
+        db.close()
+    print(f"Imported {loaded} users from {os.path.basename(args.path)} "
+          f"in {time.perf_counter() - started:.1f}s, skipped {importer.skipped} invalid rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""Процесс-отправитель рассылок.
+
+Бот при SENDER_PROCESSES > 0 не отправляет рассылки сам, а только ставит
+получателей прогона в очередь outbox. Процессы-отправители берут из нее
+сообщения пачками в аренду и доставляют их; общий лимит скорости Telegram
+делится поровну между живыми процессами, пауза flood control - общая.
+
+    python worker.py                 # один процесс
+    python worker.py --processes 4   # четыре процесса (по ядру на процесс)
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+from database import Database
+from sender import BroadcastSender, DeliveryLog, MessageTemplate, share_rate_limit
+import config
+import metrics
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class SenderWorker:
+    """Цикл одного процесса: прогон с непустой очередью -> доставка -> следующий"""
+
+    def __init__(self, db: Database, bot: Bot, worker_id: str):
+        self.db = db
+        self.bot = bot
+        self.worker_id = worker_id
+        self.sender = BroadcastSender(
+            workers=config.SEND_WORKERS,
+            rate=config.SEND_RATE_LIMIT,
+            per_chat_interval=config.SEND_PER_CHAT_INTERVAL,
+            max_retries=config.SEND_MAX_RETRIES,
+            backoff_base=config.SEND_BACKOFF_BASE,
+            backoff_max=config.SEND_BACKOFF_MAX
+        )
+
+    async def run(self):
+        # Глобальный лимит Telegram один на бота - делим его между процессами
+        heartbeat = asyncio.create_task(share_rate_limit(
+            self.db, self.sender.bucket, self.worker_id,
+            config.SEND_RATE_LIMIT, config.SENDER_HEARTBEAT_INTERVAL
+        ))
+        try:
+            while True:
+                run = await self.db.aio.next_outbox_run()
+                if run is None:
+                    await asyncio.sleep(config.SENDER_HEARTBEAT_INTERVAL)
+                    continue
+                await self._deliver_run(run)
+        finally:
+            heartbeat.cancel()
+            # Дождаться, пока процесс снимется с учета в sender_workers
+            await asyncio.gather(heartbeat, return_exceptions=True)
+            # Взятое, но не отправленное сразу возвращаем в очередь другим процессам
+            await self.db.aio.release_outbox_leases(self.worker_id)
+
+    async def _deliver_run(self, run: dict):
+        run_id = run["id"]
+        broadcast = await self.db.aio.get_broadcast(run["broadcast_id"])
+        if not broadcast:
+            return
+
+        send = MessageTemplate.for_broadcast(self.bot, broadcast).send
+        # Несколько процессов разбирают очередь одного прогона параллельно
+        recipients = self.db.aio.iter_outbox(
+            run_id,
+            self.worker_id,
+            batch_size=config.OUTBOX_BATCH_SIZE,
+            lease_seconds=config.SENDER_LEASE_TIMEOUT,
+            wait_paused=False
+        )
+        delivery_log = DeliveryLog(
+            self.db, broadcast["id"], run_id,
+            batch_size=config.DELIVERY_LOG_BATCH_SIZE,
+            flush_interval=config.DELIVERY_LOG_FLUSH_INTERVAL
+        )
+        delivery_log.start()
+        try:
+            report = await self.sender.deliver(recipients, send, delivery_log)
+        except Exception as e:
+            logger.error(f"Error sending run {run_id}: {e}")
+            await asyncio.sleep(config.SENDER_HEARTBEAT_INTERVAL)
+            return
+        finally:
+            await delivery_log.close()
+        logger.info(f"Run {run_id} queue drained by {self.worker_id}: {report.summary()}")
+
+
+async def run_worker(index: int):
+    db = Database(config.DATABASE_PATH, pool_size=config.DB_POOL_SIZE,
+                  busy_timeout=config.DB_BUSY_TIMEOUT)
+    db.init_db()
+    bot = Bot(
+        config.BOT_TOKEN,
+        base_url=config.BOT_API_URL,
+        # HTTPXRequest по умолчанию держит одно соединение - по одному на воркер отправки
+        request=HTTPXRequest(connection_pool_size=config.SEND_WORKERS)
+    )
+    worker = SenderWorker(db, bot, f"{socket.gethostname()}:{os.getpid()}:{index}")
+
+    # SIGTERM (systemd, docker stop): вернуть взятые сообщения в очередь и выйти
+    try:
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:
+        pass  # Windows
+
+    # У каждого процесса свой порт метрик: METRICS_PORT + 1 + index
+    metrics.start_server(1 + index)
+    metrics.start_loop_monitor()
+
+    logger.info(f"Sender process {worker.worker_id} started")
+    try:
+        async with bot:
+            await worker.run()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        db.close()
+        logger.info(f"Sender process {worker.worker_id} stopped")
+
+
+def run_process(index: int):
+    try:
+        asyncio.run(run_worker(index))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Процесс-отправитель рассылок")
+    parser.add_argument("--processes", type=int, default=max(1, config.SENDER_PROCESSES),
+                        help="сколько процессов запустить (по умолчанию SENDER_PROCESSES)")
+    args = parser.parse_args()
+
+    if not config.BOT_TOKEN:
+        logger.error("BOT_TOKEN не найден! Создайте файл .env с токеном бота.")
+        return
+    if config.SENDER_PROCESSES <= 0:
+        logger.warning("SENDER_PROCESSES=0: бот отправляет рассылки сам и очередь пуста")
+
+    if args.processes == 1:
+        run_process(0)
+        return
+
+    processes = [multiprocessing.Process(target=run_process, args=(index,))
+                 for index in range(args.processes)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()